@@ -0,0 +1,236 @@
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+import numpy as np
+
+from _kline_cache import KLinePageCache
+from _metrics import backoff_sleep, binance_cache_hits, binance_page_latency, binance_requests
+from _store import minute_columns
+from config import (
+    binance_kline_url,
+    binance_max_connections,
+    binance_weight_limit,
+    binance_weight_safety_margin,
+    kline_cache_enabled,
+    kline_request_weight,
+    logging,
+)
+
+kline_intervals = {
+    1: "1s",
+    60: "1m",
+    120: "3m",
+    300: "5m",
+    900: "15m",
+    1800: "30m",
+    3600: "1h",
+    7200: "2h",
+    14400: "4h",
+    21600: "6h",
+    28800: "8h",
+    43200: "12h",
+    86400: "1d",
+    259200: "3d",
+    604800: "1w",
+    2592000: "1M",
+}
+
+kline_page_size = 1000
+
+
+def decode_kline_page(data: List[list]) -> Dict[str, np.ndarray]:
+    """Turn one raw kline page into typed column arrays.
+
+    The page is validated as a whole (shape, types, ordering) instead of
+    building an object per row; minute_columns follows the Binance row layout.
+    """
+    if not data:
+        return {c: np.empty(0, dtype=dtype) for c, dtype in minute_columns.items()}
+    page = np.array(data, dtype=object)
+    if page.ndim != 2 or page.shape[1] != len(minute_columns):
+        raise ValueError(f"Unexpected kline page shape {page.shape}")
+    try:
+        columns = {
+            c: page[:, i].astype(dtype)
+            for i, (c, dtype) in enumerate(minute_columns.items())
+        }
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Malformed kline page starting at {data[0][0]}: {e}")
+    if (np.diff(columns["open_time"]) <= 0).any():
+        raise ValueError(f"Kline page starting at {data[0][0]} is not sorted")
+    return columns
+
+
+def page_grid_start(start_time_ms: int, interval_as_seconds: int = 60) -> int:
+    """Align a page start on a fixed grid so cached pages stay reusable
+    when the requested start moves"""
+    page_span_ms = kline_page_size * interval_as_seconds * 1000
+    return start_time_ms // page_span_ms * page_span_ms
+
+
+def truncate_page(
+    columns: Dict[str, np.ndarray], end_time_ms: int, start_time_ms: int = 0
+):
+    """Keep the rows opened in [start_time_ms, end_time_ms] (pages are sorted)"""
+    times = columns["open_time"]
+    start = np.searchsorted(times, start_time_ms, "left")
+    stop = np.searchsorted(times, end_time_ms, "right")
+    if start == 0 and stop == len(times):
+        return columns
+    return {c: v[start:stop] for c, v in columns.items()}
+
+
+class WeightRateLimiter:
+    """Token bucket shared by every coroutine talking to the Binance REST API.
+
+    The bucket refills at ``weight_limit * safety_margin`` per minute and is
+    corrected with the used weight and Retry-After headers Binance sends back,
+    so every request in the process waits on the same budget.
+    """
+
+    def __init__(
+        self,
+        weight_limit: int = binance_weight_limit,
+        safety_margin: float = binance_weight_safety_margin,
+    ):
+        self.capacity = weight_limit * safety_margin
+        self.refill_rate = self.capacity / 60
+        self.waited_seconds = 0.0
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, weight: int = kline_request_weight):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= weight:
+                        self._tokens -= weight
+                        return
+                    wait = (weight - self._tokens) / self.refill_rate
+                self.waited_seconds += wait
+                backoff_sleep.inc(wait, reason="rate_limit")
+                await asyncio.sleep(wait)
+
+    def update_from_response(self, status: int, headers):
+        used = headers.get("X-MBX-USED-WEIGHT-1M")
+        if used is not None:
+            # The server counter is the source of truth, never trust a fuller bucket
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, self.capacity - int(used))
+        if status in (418, 429):
+            retry_after = int(headers.get("Retry-After", 60))
+            logging.warning(
+                f"Binance sent status({status}), pausing every request for {retry_after}s"
+            )
+            self._tokens = 0
+            self._blocked_until = max(
+                self._blocked_until, time.monotonic() + retry_after
+            )
+
+    def _refill(self, now: float):
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.refill_rate
+        )
+        self._updated_at = now
+
+
+class AsyncBinanceKLine:
+    """Fetches kline pages over one pooled keep-alive session."""
+
+    _retry_sleeps = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+    def __init__(
+        self,
+        limiter: Optional[WeightRateLimiter] = None,
+        kline_url: str = binance_kline_url,
+        max_connections: int = binance_max_connections,
+        use_cache: bool = kline_cache_enabled,
+    ):
+        self.limiter = limiter or WeightRateLimiter()
+        self.kline_url = kline_url
+        self.max_connections = max_connections
+        self.cache = KLinePageCache() if use_cache else None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.pages = 0
+        self.retries = 0
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            raise_for_status=False,
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.session is not None:
+            await self.session.close()
+
+    async def get_page(
+        self,
+        symbol: str,
+        start_time_ms: int,
+        interval_as_seconds: int = 60,
+        limit: int = kline_page_size,
+    ) -> List[list]:
+        assert self.session is not None, "Use AsyncBinanceKLine as a context manager"
+        params = {
+            "symbol": symbol,
+            "startTime": start_time_ms,
+            "interval": kline_intervals[interval_as_seconds],
+            "limit": limit,
+        }
+        if self.cache is not None:
+            data = self.cache.get(symbol, params["interval"], start_time_ms, limit)
+            if data is not None:
+                binance_cache_hits.inc()
+                return data
+        for attempt, sleep_time in enumerate(self._retry_sleeps):
+            if attempt:
+                self.retries += 1
+            await self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                async with self.session.get(self.kline_url, params=params) as response:
+                    self.limiter.update_from_response(response.status, response.headers)
+                    binance_requests.inc(status=response.status)
+                    if response.status == 200:
+                        self.pages += 1
+                        raw = await response.read()
+                        data = json.loads(raw)
+                        binance_page_latency.observe(time.monotonic() - started)
+                        if self.cache is not None:
+                            self.cache.put(
+                                symbol, params["interval"], start_time_ms, limit, raw, data
+                            )
+                        return data
+                    text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                binance_requests.inc(status="error")
+                logging.warning(f"{symbol} | Request failed ({e!r}), retry in {sleep_time}s")
+                backoff_sleep.inc(sleep_time, reason="retry")
+                await asyncio.sleep(sleep_time)
+                continue
+            if response.status in (418, 429):
+                # The limiter already holds every request until Retry-After
+                continue
+            if response.status >= 500:
+                logging.warning(
+                    f"{symbol} | Binance sent status({response.status}), retry in {sleep_time}s"
+                )
+                backoff_sleep.inc(sleep_time, reason="retry")
+                await asyncio.sleep(sleep_time)
+                continue
+            logging.error(
+                f"Binance sent not successed status({response.status}) whit message {text}"
+            )
+            raise Exception(text)
+        raise Exception("All waits is do nothing")
@@ -0,0 +1,393 @@
+"""Local stand-in for the Binance klines endpoint and kline websocket.
+
+Serves deterministic synthetic kline pages (or pages recorded from the real
+API) so the ingestion can be run and timed offline:
+
+    python _binance_standin.py --port 8900 --latency-ms 30 --rate-429 0.01
+    BINANCE_API_URL=http://127.0.0.1:8900 python populate_price_by_minutes.py
+
+With --upstream the stand-in proxies to the real API and records every page
+in --recordings; without it, recorded pages are replayed when present.
+
+/stream serves the combined kline stream. Bars come from --replay-store (a
+minute store directory) or are synthetic, on a clock that starts at
+--stream-start and runs --stream-speed times faster than real time; the
+REST endpoint follows the same clock, so gaps can be filled after a
+reconnect. --stream-drop-after closes each connection after that many
+messages to exercise reconnects:
+
+    python _binance_standin.py --port 8900 --stream-speed 60 --replay-store data/0_by_minutes
+    BINANCE_API_URL=http://127.0.0.1:8900 BINANCE_STREAM_URL=ws://127.0.0.1:8900 \\
+        python stream_price_by_minutes.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+from pydantic import BaseModel
+
+from _binance import kline_intervals
+from _store import minute_store, month_keys
+from config import binance_weight_limit, kline_request_weight, logging
+
+interval_milliseconds = {v: k * 1000 for k, v in kline_intervals.items()}
+
+
+class StandInOptions(BaseModel):
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    rate_429: float = 0
+    rate_418: float = 0
+    retry_after: int = 1
+    weight_limit: int = binance_weight_limit
+    seed: int = 0
+    recordings: Optional[Path] = None
+    upstream: Optional[str] = None
+    stream_speed: float = 1
+    stream_start_ms: Optional[int] = None
+    stream_drop_after: int = 0
+    replay_store: Optional[Path] = None
+
+
+def _uniform(idx: np.ndarray, seed: int) -> np.ndarray:
+    """splitmix64 of (idx + seed) mapped to [0, 1), same value for the same minute"""
+    with np.errstate(over="ignore"):
+        x = (idx.astype(np.uint64) + np.uint64(seed)) * np.uint64(0x9E3779B97F4A7C15)
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    return (x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def synthetic_klines(
+    symbol: str,
+    interval_ms: int,
+    start_ms: int,
+    end_ms: int,
+    limit: int,
+    seed: int = 0,
+) -> List[list]:
+    first = -(-start_ms // interval_ms) * interval_ms
+    times = first + np.arange(limit, dtype=np.int64) * interval_ms
+    times = times[times <= end_ms]
+    if not len(times):
+        return []
+    symbol_seed = zlib.crc32(symbol.encode()) + seed
+    idx = times // interval_ms
+
+    def price(i):
+        wave = 1 + 0.05 * np.sin(i * interval_ms / 86_400_000 * 2 * np.pi / 7)
+        return (1 + symbol_seed % 1000) * wave * (1 + 0.002 * _uniform(i, symbol_seed))
+
+    open_ = price(idx)
+    close = price(idx + 1)
+    high = np.maximum(open_, close) * (1 + 0.001 * _uniform(idx, symbol_seed + 1))
+    low = np.minimum(open_, close) * (1 - 0.001 * _uniform(idx, symbol_seed + 2))
+    volume = 10 + 100 * _uniform(idx, symbol_seed + 3)
+    taker_base = volume * _uniform(idx, symbol_seed + 4)
+    trades = (1 + 500 * _uniform(idx, symbol_seed + 5)).astype(np.int64)
+
+    def fmt(values):
+        return np.char.mod("%.8f", values).tolist()
+
+    return [
+        list(row)
+        for row in zip(
+            times.tolist(),
+            fmt(open_),
+            fmt(high),
+            fmt(low),
+            fmt(close),
+            fmt(volume),
+            (times + interval_ms - 1).tolist(),
+            fmt(volume * close),
+            trades.tolist(),
+            fmt(taker_base),
+            fmt(taker_base * close),
+            ["0"] * len(times),
+        )
+    ]
+
+
+class KLineStandIn:
+    def __init__(self, options: StandInOptions):
+        self.options = options
+        self.requests = 0
+        self._minute = 0
+        self._used_weight = 0
+        self._upstream: Optional[aiohttp.ClientSession] = None
+        self._clock_origin = (
+            time.monotonic(),
+            options.stream_start_ms or int(time.time() * 1000),
+        )
+        self._replay_months: Dict[str, Tuple[str, dict]] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/v3/klines", self.klines)
+        app.router.add_get("/stream", self.stream)
+        app.on_cleanup.append(self._close_upstream)
+        return app
+
+    def now_ms(self) -> int:
+        """Stand-in clock, real time unless a stream start or speed is set"""
+        started, start_ms = self._clock_origin
+        return int(start_ms + (time.monotonic() - started) * 1000 * self.options.stream_speed)
+
+    def rows(
+        self, symbol: str, interval_ms: int, start_ms: int, end_ms: int, limit: int
+    ) -> List[list]:
+        if self.options.replay_store is None or interval_ms != 60_000:
+            return synthetic_klines(
+                symbol, interval_ms, start_ms, end_ms, limit, self.options.seed
+            )
+        # month by month, up to the first limit rows: a page normally covers
+        # start_ms .. start_ms + (limit - 1) minutes, and only reads further
+        # when the store has a gap there (Binance also skips gaps)
+        store = minute_store(symbol, self.options.replay_store)
+        parts: List[Dict[str, np.ndarray]] = []
+        rows = 0
+        for chunk in store.iter_months(None, start_ms, end_ms):
+            parts.append(chunk)
+            rows += len(chunk["open_time"])
+            if rows >= limit:
+                break
+        data = {
+            c: np.concatenate([p[c] for p in parts]) if parts else np.empty(0, dtype=t)
+            for c, t in store.schema.items()
+        }
+        return self._format_rows(data, limit)
+
+    def bar(self, symbol: str, open_time_ms: int) -> Optional[list]:
+        """One stored or synthetic minute bar, the stored month is kept in memory"""
+        if self.options.replay_store is None:
+            return synthetic_klines(
+                symbol, 60_000, open_time_ms, open_time_ms, 1, self.options.seed
+            )[0]
+        month = str(month_keys(np.array([open_time_ms]))[0])
+        cached = self._replay_months.get(symbol)
+        if cached is None or cached[0] != month:
+            store = minute_store(symbol, self.options.replay_store)
+            chunk = store.read_month(month) if month in store.months() else None
+            cached = self._replay_months[symbol] = (month, chunk)
+        chunk = cached[1]
+        if chunk is None:
+            return None
+        i = np.searchsorted(chunk["open_time"], open_time_ms)
+        if i == len(chunk["open_time"]) or chunk["open_time"][i] != open_time_ms:
+            return None
+        rows = self._format_rows({c: v[i : i + 1] for c, v in chunk.items()}, 1)
+        return rows[0]
+
+    @staticmethod
+    def _format_rows(data: dict, limit: int) -> List[list]:
+        data = {c: v[:limit] for c, v in data.items()}
+
+        def fmt(values):
+            return np.char.mod("%.8f", values).tolist()
+
+        return [
+            list(row)
+            for row in zip(
+                data["open_time"].tolist(),
+                fmt(data["open"]),
+                fmt(data["high"]),
+                fmt(data["low"]),
+                fmt(data["close"]),
+                fmt(data["volume"]),
+                data["close_time"].tolist(),
+                fmt(data["quote_volume"]),
+                data["trades"].tolist(),
+                fmt(data["taker_base_volume"]),
+                fmt(data["taker_quote_volume"]),
+                np.char.mod("%d", data["ignore"]).tolist(),
+            )
+        ]
+
+    async def stream(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        symbols = [
+            i.split("@")[0].upper()
+            for i in request.query.get("streams", "").split("/")
+            if i
+        ]
+        logging.info(f"Stream connected for {len(symbols)} symbols")
+        sent = 0
+        last_sent = None
+        while not ws.closed:
+            now_ms = self.now_ms()
+            last_closed = now_ms // 60_000 * 60_000 - 60_000
+            first = last_closed if last_sent is None else last_sent + 60_000
+            for open_time in range(first, last_closed + 1, 60_000):
+                for symbol in symbols:
+                    row = self.bar(symbol, open_time)
+                    if row is None:
+                        continue
+                    for closed in (False, True):
+                        await ws.send_json(self._kline_event(symbol, row, closed))
+                        sent += 1
+                    if self.options.stream_drop_after and sent >= self.options.stream_drop_after:
+                        await ws.close()
+                        return ws
+                last_sent = open_time
+            wait_ms = 60_000 - now_ms % 60_000
+            await asyncio.sleep(wait_ms / 1000 / self.options.stream_speed)
+        return ws
+
+    @staticmethod
+    def _kline_event(symbol: str, row: list, closed: bool) -> dict:
+        return {
+            "stream": f"{symbol.lower()}@kline_1m",
+            "data": {
+                "e": "kline",
+                "E": row[6] + 1,
+                "s": symbol,
+                "k": {
+                    "t": row[0],
+                    "T": row[6],
+                    "s": symbol,
+                    "i": "1m",
+                    "o": row[1],
+                    "c": row[4],
+                    "h": row[2],
+                    "l": row[3],
+                    "v": row[5],
+                    "n": row[8],
+                    "x": closed,
+                    "q": row[7],
+                    "V": row[9],
+                    "Q": row[10],
+                    "B": row[11],
+                },
+            },
+        }
+
+    async def klines(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        options = self.options
+        if options.latency_ms or options.jitter_ms:
+            await asyncio.sleep(
+                (options.latency_ms + random.uniform(0, options.jitter_ms)) / 1000
+            )
+        minute = int(self.now_ms() // 60_000)
+        if minute != self._minute:
+            self._minute, self._used_weight = minute, 0
+        self._used_weight += kline_request_weight
+        headers = {"X-MBX-USED-WEIGHT-1M": str(self._used_weight)}
+        retry_after = str(options.retry_after)
+        if random.random() < options.rate_418:
+            return self._error(418, "IP banned until later.", headers, retry_after)
+        if self._used_weight > options.weight_limit:
+            retry_after = str(60 - int(time.time() % 60))
+            return self._error(429, "Too much request weight used.", headers, retry_after)
+        if random.random() < options.rate_429:
+            return self._error(429, "Too much request weight used.", headers, retry_after)
+
+        query = request.query
+        interval = query.get("interval", "")
+        if interval not in interval_milliseconds:
+            return web.json_response(
+                {"code": -1120, "msg": "Invalid interval."}, status=400, headers=headers
+            )
+        limit = min(int(query.get("limit", 500)), 1000)
+        now_ms = self.now_ms()
+        end_ms = min(int(query.get("endTime", now_ms)), now_ms)
+        interval_ms = interval_milliseconds[interval]
+        start_ms = int(query.get("startTime", end_ms - (limit - 1) * interval_ms))
+
+        record = None
+        if options.recordings is not None:
+            record = options.recordings.joinpath(
+                f"{query.get('symbol')}_{interval}_{start_ms}_{limit}.json"
+            )
+        if options.upstream is not None:
+            data = await self._fetch_upstream(query)
+            if record is not None:
+                record.parent.mkdir(parents=True, exist_ok=True)
+                record.write_text(json.dumps(data))
+        elif record is not None and record.exists():
+            data = json.loads(record.read_text())
+        else:
+            data = self.rows(query.get("symbol", ""), interval_ms, start_ms, end_ms, limit)
+        return web.json_response(data, headers=headers)
+
+    def _error(self, status: int, msg: str, headers: dict, retry_after: str):
+        return web.json_response(
+            {"code": -1003, "msg": msg},
+            status=status,
+            headers={**headers, "Retry-After": retry_after},
+        )
+
+    async def _fetch_upstream(self, query) -> list:
+        if self._upstream is None:
+            self._upstream = aiohttp.ClientSession()
+        async with self._upstream.get(
+            f"{self.options.upstream}/api/v3/klines", params=dict(query)
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def _close_upstream(self, app):
+        if self._upstream is not None:
+            await self._upstream.close()
+
+
+def run_standin(options: StandInOptions, host: str = "127.0.0.1", port: int = 8900):
+    logging.info(f"Binance stand-in listening on http://{host}:{port}")
+    web.run_app(
+        KLineStandIn(options).app(), host=host, port=port, print=None, access_log=None
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--rate-429", type=float, default=0)
+    parser.add_argument("--rate-418", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--weight-limit", type=int, default=binance_weight_limit)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--recordings", type=Path)
+    parser.add_argument("--upstream", help="e.g. https://api.binance.com to record")
+    parser.add_argument("--stream-speed", type=float, default=1)
+    parser.add_argument(
+        "--stream-start", help="UTC date the stand-in clock starts at, e.g. 2023-11-01"
+    )
+    parser.add_argument("--stream-drop-after", type=int, default=0)
+    parser.add_argument("--replay-store", type=Path)
+    args = parser.parse_args()
+    run_standin(
+        StandInOptions(
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            rate_429=args.rate_429,
+            rate_418=args.rate_418,
+            retry_after=args.retry_after,
+            weight_limit=args.weight_limit,
+            seed=args.seed,
+            recordings=args.recordings,
+            upstream=args.upstream,
+            stream_speed=args.stream_speed,
+            stream_start_ms=int(np.datetime64(args.stream_start, "ms").astype(np.int64))
+            if args.stream_start
+            else None,
+            stream_drop_after=args.stream_drop_after,
+            replay_store=args.replay_store,
+        ),
+        args.host,
+        args.port,
+    )
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from _feature_files import read_features, time_column
+from config import feature_cache_max_bytes, feature_cache_path, logging
+
+Matrix = Tuple[np.ndarray, np.ndarray]
+
+
+class FeatureMatrixCache:
+    """Parsed feature files as memory-mapped .npy, keyed by (path, columns).
+
+    An entry holds the sorted "Open time" of every row and a float64 matrix
+    of the requested columns, plus the mtime and size of the file it was
+    parsed from. Entries are mapped on every later read, in this process or
+    the next one, so a file is parsed again only after it changed; its entry
+    is then replaced, not left behind next to the new one. The mapped
+    entries and the entries on disk are both kept under ``max_bytes``,
+    dropping the least recently used first (reads bump the mtime of the
+    entry on disk).
+    """
+
+    def __init__(self, root: Path = feature_cache_path, max_bytes: int = feature_cache_max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._mapped: "OrderedDict[str, Tuple[str, Matrix]]" = OrderedDict()
+
+    @staticmethod
+    def key(feature_file: Path, columns: List[str]) -> str:
+        return hashlib.sha256(f"{feature_file.resolve()}|{','.join(columns)}".encode()).hexdigest()
+
+    @staticmethod
+    def stamp(feature_file: Path) -> str:
+        stat = feature_file.stat()
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    def path(self, key: str) -> Path:
+        return self.root.joinpath(key)
+
+    def get(self, feature_file: Path, columns: List[str]) -> Matrix:
+        """Open times and the ``columns`` matrix of a feature file"""
+        key, stamp = self.key(feature_file, columns), self.stamp(feature_file)
+        if key in self._mapped and self._mapped[key][0] == stamp:
+            self._mapped.move_to_end(key)
+            self.hits += 1
+            return self._mapped[key][1]
+        path = self.path(key)
+        try:
+            if path.joinpath("stamp").read_text() != stamp:
+                raise FileNotFoundError(path)
+            matrix = self._map(path)
+            os.utime(path)
+            self.hits += 1
+        except FileNotFoundError:
+            self.misses += 1
+            self._write(path, feature_file, columns, stamp)
+            matrix = self._map(path)
+            self.evict()
+        self._mapped[key] = (stamp, matrix)
+        self._mapped.move_to_end(key)
+        while len(self._mapped) > 1 and self._mapped_bytes() > self.max_bytes:
+            self._mapped.popitem(last=False)
+        return matrix
+
+    @staticmethod
+    def _map(path: Path) -> Matrix:
+        return (
+            np.load(path.joinpath("times.npy"), mmap_mode="r"),
+            np.load(path.joinpath("values.npy"), mmap_mode="r"),
+        )
+
+    @staticmethod
+    def _write(path: Path, feature_file: Path, columns: List[str], stamp: str):
+        data = read_features(feature_file, columns=columns).sort_values(time_column)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.mkdir(parents=True, exist_ok=True)
+        np.save(tmp.joinpath("times.npy"), data[time_column].to_numpy(dtype=np.int64))
+        np.save(tmp.joinpath("values.npy"), data[columns].to_numpy(dtype=np.float64))
+        tmp.joinpath("stamp").write_text(stamp)
+        # the entry of an older version of the file, arrays mapped from it
+        # stay readable after it is removed
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            tmp.rename(path)
+        except OSError:
+            # written meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _mapped_bytes(self) -> int:
+        return sum(t.nbytes + v.nbytes for _, (t, v) in self._mapped.values())
+
+    def evict(self, target_ratio: float = 0.9):
+        """Drop the least recently used entries on disk down to target_ratio of max_bytes"""
+        entries: Dict[Path, Tuple[float, int]] = {}
+        for entry in self.root.iterdir():
+            if entry.is_dir() and not entry.name.endswith(".tmp"):
+                size = sum(i.stat().st_size for i in entry.iterdir())
+                entries[entry] = (entry.stat().st_mtime, size)
+        size = sum(s for _, s in entries.values())
+        if size <= self.max_bytes:
+            return
+        removed = 0
+        for entry, (_, entry_size) in sorted(entries.items(), key=lambda i: i[1][0]):
+            if size <= self.max_bytes * target_ratio:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            size -= entry_size
+            removed += 1
+        logging.info(f"Feature cache: evicted {removed} entries, {size} bytes left")
+
+
+feature_cache = FeatureMatrixCache()
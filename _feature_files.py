@@ -0,0 +1,135 @@
+"""Time range reads of the feature csv files.
+
+Each feature file gets a month index in feature_index_path: the byte offset
+of the first row of every month, plus the size and mtime of the file it was
+built for. read_features() seeks to the months covering the range and
+parses only those rows and the requested columns. An index whose size or
+mtime does not match the file is rebuilt on the next read, so a file
+written without updating it (even to the same size) is still read
+correctly. "Open time" must be the first column of the file.
+"""
+import io
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from _store import month_keys
+from config import feature_index_path
+
+time_column = "Open time"
+
+
+def index_file(feature_file: Path) -> Path:
+    return feature_index_path.joinpath(f"{feature_file.stem}.json")
+
+
+def _month_of(line: bytes) -> str:
+    return str(month_keys(np.array([int(line[: line.index(b",")])]))[0])
+
+
+def index_feature_file(feature_file: Path, from_offset: Optional[int] = None) -> dict:
+    """Write the month index of a file.
+
+    With ``from_offset`` (where the file was last truncated and appended to)
+    the months starting before it are kept and only the rest is scanned.
+    """
+    months: Dict[str, int] = {}
+    if from_offset is not None and index_file(feature_file).exists():
+        old = json.loads(index_file(feature_file).read_text())
+        months = {m: o for m, o in old["months"].items() if o < from_offset}
+    with open(feature_file, "rb") as f:
+        header = f.readline()
+        if header.decode().rstrip("\r\n").split(",")[0] != time_column:
+            raise ValueError(f"{feature_file} | the first column is not {time_column}")
+        position = max(from_offset or 0, len(header)) if months else len(header)
+        f.seek(position)
+        last = max(months) if months else None
+        for line in f:
+            if line.strip():
+                month = _month_of(line)
+                if month != last:
+                    months[month] = position
+                    last = month
+            position += len(line)
+    stat = feature_file.stat()
+    index = {
+        "size": position,
+        "mtime_ns": stat.st_mtime_ns,
+        "header": len(header),
+        "months": months,
+    }
+    feature_index_path.mkdir(parents=True, exist_ok=True)
+    index_file(feature_file).write_text(json.dumps(index))
+    return index
+
+
+def _load_index(feature_file: Path) -> dict:
+    file = index_file(feature_file)
+    if file.exists():
+        index = json.loads(file.read_text())
+        stat = feature_file.stat()
+        if (index["size"], index.get("mtime_ns")) == (stat.st_size, stat.st_mtime_ns):
+            return index
+    return index_feature_file(feature_file)
+
+
+def row_offset(feature_file: Path, time_ms: int) -> int:
+    """Byte offset of the first row with ``Open time >= time_ms`` (the file
+    size when there is none), scanning one month of rows at most"""
+    index = _load_index(feature_file)
+    month = str(month_keys(np.array([time_ms]))[0])
+    later = [o for m, o in sorted(index["months"].items()) if m > month]
+    end = later[0] if later else index["size"]
+    if month not in index["months"]:
+        return end
+    position = index["months"][month]
+    with open(feature_file, "rb") as f:
+        f.seek(position)
+        while position < end:
+            line = f.readline()
+            if line.strip() and int(line[: line.index(b",")]) >= time_ms:
+                return position
+            position += len(line)
+    return end
+
+
+def read_features(
+    feature_file: Path,
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+    columns: Optional[Iterable[str]] = None,
+    float_precision: Optional[str] = None,
+) -> pd.DataFrame:
+    """Rows with ``start_ms <= Open time <= end_ms``, "Open time" and ``columns`` only.
+
+    ``float_precision`` goes to pd.read_csv, "round_trip" for values that are
+    written back (about 3 times slower to parse).
+    """
+    index = _load_index(feature_file)
+    months = sorted(index["months"].items())
+    begin, end = index["header"], index["size"]
+    if start_ms is not None:
+        first = str(month_keys(np.array([start_ms]))[0])
+        starts = [o for m, o in months if m <= first]
+        begin = starts[-1] if starts else begin
+    if end_ms is not None:
+        last = str(month_keys(np.array([end_ms]))[0])
+        ends = [o for m, o in months if m > last]
+        end = ends[0] if ends else end
+    with open(feature_file, "rb") as f:
+        header = f.read(index["header"])
+        f.seek(begin)
+        body = f.read(max(end - begin, 0))
+    usecols = None if columns is None else [time_column] + [c for c in columns if c != time_column]
+    data = pd.read_csv(io.BytesIO(header + body), usecols=usecols, float_precision=float_precision)
+    if usecols is not None:
+        data = data[usecols]
+    keep = np.ones(len(data), dtype=bool)
+    if start_ms is not None:
+        keep &= data[time_column].to_numpy() >= start_ms
+    if end_ms is not None:
+        keep &= data[time_column].to_numpy() <= end_ms
+    return data[keep].reset_index(drop=True)
@@ -0,0 +1,218 @@
+"""Registry of the indicator columns written to the half-day feature files.
+
+Every node declares the columns it produces, the columns it reads and its
+parameters (bound with partial). build_features() walks the graph from the
+requested columns, so a node runs once however many of its outputs are used,
+and nodes nobody asked for are never computed. Names starting with "_" are
+intermediates shared between features and never written out.
+
+fingerprints() hashes the code and parameters of every node a column goes
+through, so a feature file can keep the columns that did not change and
+recompute only the others.
+"""
+import hashlib
+import inspect
+from functools import partial
+from typing import Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+import talib
+
+from config import feature_dtype, timeperiod_list
+
+
+class Node(NamedTuple):
+    outputs: Tuple[str, ...]
+    inputs: Tuple[str, ...]
+    compute: Callable
+
+
+registry: Dict[str, Node] = {}
+
+
+def register(outputs: Iterable[str], inputs: Iterable[str], compute: Callable):
+    node = Node(tuple(outputs), tuple(inputs), compute)
+    for name in node.outputs:
+        registry[name] = node
+
+
+def _shift(values: np.ndarray, periods: int) -> np.ndarray:
+    shifted = np.full_like(values, np.nan)
+    shifted[periods:] = values[:-periods]
+    return shifted
+
+
+def _change(close: np.ndarray, previous: np.ndarray) -> np.ndarray:
+    """(close - previous) / previous, with the pandas inf/nan on a zero previous"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (close - previous) / previous
+
+
+def _talib_ratio(close: np.ndarray, previous: np.ndarray) -> np.ndarray:
+    """close / previous, 0 where previous is 0 like the TA-Lib ROC family"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(previous == 0, 0, close / previous)
+
+
+def _talib_rocp(close: np.ndarray, previous: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(previous == 0, 0, (close - previous) / previous)
+
+
+def _roc(ratio: np.ndarray, previous: np.ndarray) -> np.ndarray:
+    return np.where(previous == 0, 0, (ratio - 1) * 100)
+
+
+def _rocr100(ratio: np.ndarray) -> np.ndarray:
+    return ratio * 100
+
+
+ohlc = ("High", "Low", "Close")
+change_periods = sorted({1, 24, 48, 72, 96, *timeperiod_list})
+
+for n in change_periods:
+    register([f"_CLOSE_{n}_AGO"], ["Close"], partial(_shift, periods=n))
+for n in (24, 48, 72, 96, 1):
+    register([f"CPG{n}"], ["Close", f"_CLOSE_{n}_AGO"], _change)
+register(["APO"], ["Close"], talib.APO)
+register(["CCI_30"], ohlc, partial(talib.CCI, timeperiod=30))
+for tp in timeperiod_list:
+    register([f"CMO_{tp}"], ["Close"], partial(talib.CMO, timeperiod=tp))
+for tp in timeperiod_list:
+    register([f"DEMA_{tp}"], ["Close"], partial(talib.DEMA, timeperiod=tp))
+for tp in timeperiod_list:
+    register([f"EMA_{tp}"], ["Close"], partial(talib.EMA, timeperiod=tp))
+register(["HT_TRENDLINE"], ["Close"], talib.HT_TRENDLINE)
+register(["MACD", "MACDSIGNAL", "MACDHIST"], ["Close"], talib.MACD)
+register(["MACDEXT", "MACDEXTSIGNAL", "MACDEXTHIST"], ["Close"], talib.MACDEXT)
+register(["MACDFIX", "_MACDFIXSIGNAL", "MACDFIXHIST"], ["Close"], talib.MACDFIX)
+register(["MIDPOINT_20"], ["Close"], partial(talib.MIDPOINT, timeperiod=20))
+register(["MIDPRICE_20"], ["High", "Low"], partial(talib.MIDPRICE, timeperiod=20))
+register(["MINUS_DI_20"], ohlc, partial(talib.MINUS_DI, timeperiod=20))
+for tp in timeperiod_list:
+    register([f"MOM_{tp}"], ["Close"], partial(talib.MOM, timeperiod=tp))
+register(["PLUS_DI_10"], ohlc, partial(talib.PLUS_DI, timeperiod=10))
+register(["PLUS_DI_30"], ohlc, partial(talib.PLUS_DI, timeperiod=30))
+register(["PPO"], ["Close"], talib.PPO)
+# the TA-Lib ROC family is one ratio to the close tp bars ago
+for tp in timeperiod_list:
+    register([f"_RATIO_{tp}"], ["Close", f"_CLOSE_{tp}_AGO"], _talib_ratio)
+for tp in timeperiod_list:
+    register([f"ROCP_{tp}"], ["Close", f"_CLOSE_{tp}_AGO"], _talib_rocp)
+for tp in timeperiod_list:
+    register([f"ROCR_{tp}"], [f"_RATIO_{tp}"], np.copy)
+for tp in timeperiod_list:
+    register([f"ROCR100_{tp}"], [f"_RATIO_{tp}"], _rocr100)
+for tp in timeperiod_list:
+    register([f"ROC_{tp}"], [f"_RATIO_{tp}", f"_CLOSE_{tp}_AGO"], _roc)
+for tp in timeperiod_list:
+    register([f"RSI_{tp}"], ["Close"], partial(talib.RSI, timeperiod=tp))
+register(["T3_20"], ["Close"], partial(talib.T3, timeperiod=20))
+for tp in timeperiod_list:
+    register([f"TRIMA_{tp}"], ["Close"], partial(talib.TRIMA, timeperiod=tp))
+register(["TRIX_10"], ["Close"], partial(talib.TRIX, timeperiod=10))
+register(["TRIX_20"], ["Close"], partial(talib.TRIX, timeperiod=20))
+for tp in timeperiod_list:
+    register([f"WMA_{tp}"], ["Close"], partial(talib.WMA, timeperiod=tp))
+for tp in (20, 30):
+    register(
+        [f"ULTOSC_{tp}"],
+        ohlc,
+        partial(talib.ULTOSC, timeperiod1=tp, timeperiod2=tp * 2, timeperiod3=tp * 4),
+    )
+# one BBANDS call gives the three bands of a period
+for tp in timeperiod_list:
+    register(
+        [f"_BB_UPPER_{tp}", f"_BB_MIDDLE_{tp}", f"_BB_LOWER_{tp}"],
+        ["Close"],
+        partial(talib.BBANDS, timeperiod=tp, nbdevup=2, nbdevdn=2, matype=0),
+    )
+register(["middleband_SMA_10"], ["_BB_MIDDLE_10"], np.copy)
+register(["middleband_SMA_20"], ["_BB_MIDDLE_20"], np.copy)
+# BBANDS returns the upper band first, this column has always held it
+register(["lowerband_SMA_30"], ["_BB_UPPER_30"], np.copy)
+
+
+def resolve(columns: Iterable[str], available: Iterable[str]) -> List[Node]:
+    """Nodes needed for ``columns``, each after the nodes it reads from"""
+    available = set(available)
+    order: List[Node] = []
+
+    def visit(name: str):
+        if name in available:
+            return
+        if name not in registry:
+            raise KeyError(f"Unknown feature {name}")
+        node = registry[name]
+        for i in node.inputs:
+            visit(i)
+        order.append(node)
+        available.update(node.outputs)
+
+    for name in columns:
+        visit(name)
+    return order
+
+
+def _code_fingerprint(compute: Callable) -> str:
+    if isinstance(compute, partial):
+        return f"{_code_fingerprint(compute.func)}{compute.args}{sorted(compute.keywords.items())}"
+    module = getattr(compute, "__module__", None) or ""
+    name = f"{module}.{getattr(compute, '__qualname__', repr(compute))}"
+    if module == __name__:
+        return f"{name}:{inspect.getsource(compute)}"
+    if module.startswith("talib"):
+        return f"{name}:{talib.__version__}"
+    return name
+
+
+def fingerprints(columns: Iterable[str]) -> Dict[str, str]:
+    """Fingerprint of each requested feature, raw columns are left out"""
+    memo: Dict[str, str] = {}
+
+    def fingerprint(name: str) -> str:
+        if name not in registry:
+            return name
+        if name not in memo:
+            node = registry[name]
+            parts = [_code_fingerprint(node.compute), repr(node.outputs)]
+            parts += [fingerprint(i) for i in node.inputs]
+            digest = hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+            memo[name] = f"{name}:{digest}"
+        return memo[name]
+
+    return {c: fingerprint(c) for c in columns if c in registry}
+
+
+def _with_features(
+    data: pd.DataFrame, columns: List[str], values: Dict[str, np.ndarray], dtype: str
+) -> pd.DataFrame:
+    wanted = set(columns)
+    features = [n for n in registry if n in wanted and not n.startswith("_")]
+    added = [n for n in features if n not in data.columns]
+    if added:
+        # one block cast once, instead of a column insert (or cast) per feature
+        block = np.column_stack([values[n] for n in added]).astype(dtype)
+        data = pd.concat([data, pd.DataFrame(block, columns=added, index=data.index)], axis=1)
+    return data[[c for c in data.columns if c not in registry] + features]
+
+
+def build_features(
+    data: pd.DataFrame, columns: Iterable[str], dtype: str = feature_dtype
+) -> pd.DataFrame:
+    """Add the requested feature columns that ``data`` lacks.
+
+    Columns of ``data`` that are not features are kept first, then the
+    requested features in registry order, the added ones as ``dtype``; other
+    feature columns are dropped.
+    """
+    columns = list(columns)
+    values = {c: data[c].to_numpy(np.float64) for c in data.columns if c in ohlc}
+    for node in resolve(columns, data.columns):
+        inputs = [values[i] for i in node.inputs]
+        results = node.compute(*inputs)
+        if len(node.outputs) == 1:
+            results = (results,)
+        values.update(zip(node.outputs, results))
+    return _with_features(data, columns, values, dtype)
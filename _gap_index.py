@@ -0,0 +1,136 @@
+import json
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from _store import ChunkedStore
+
+Range = Tuple[int, int]
+
+
+def subtract_ranges(ranges: List[Range], removed: List[Range]) -> List[Range]:
+    """Parts of ``ranges`` not covered by ``removed`` (both inclusive, sorted)"""
+    result = []
+    for start, end in ranges:
+        for r_start, r_end in removed:
+            if r_end < start or r_start > end:
+                continue
+            if r_start > start:
+                result.append((start, r_start - 1))
+            start = r_end + 1
+            if start > end:
+                break
+        if start <= end:
+            result.append((start, end))
+    return result
+
+
+def merge_ranges(ranges: List[Range], interval_ms: int) -> List[Range]:
+    merged: List[Range] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + interval_ms:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def intersect_ranges(ranges: List[Range], other: List[Range]) -> List[Range]:
+    return subtract_ranges(ranges, subtract_ranges(ranges, other))
+
+
+class GapIndex:
+    """Sidecar ``index.json`` of a minute store: covered ranges and gaps.
+
+    Each month is scanned once and summarised (first/last open time and the
+    holes inside it); a month is only rescanned when its chunk signature
+    changes. Ranges the exchange has no data for are recorded as checked so
+    they are not requested again on every backfill.
+    """
+
+    def __init__(self, store: ChunkedStore, interval_ms: int = 60_000):
+        self.store = store
+        self.interval_ms = interval_ms
+        self.path = store.root.joinpath("index.json")
+        self.months: Dict[str, dict] = {}
+        self.checked: List[Range] = []
+        if self.path.exists():
+            data = json.loads(self.path.read_text())
+            self.months = data["months"]
+            self.checked = [tuple(i) for i in data["checked"]]
+
+    def refresh(self) -> "GapIndex":
+        months = self.store.months()
+        self.months = {k: v for k, v in self.months.items() if k in months}
+        for month in months:
+            signature = self.store.month_signature(month)
+            if self.months.get(month, {}).get("signature") == signature:
+                continue
+            times = self.store.read_month(month, [self.store.time_column])[
+                self.store.time_column
+            ]
+            holes = np.nonzero(np.diff(times) > self.interval_ms)[0]
+            self.months[month] = {
+                "signature": signature,
+                "first": int(times[0]),
+                "last": int(times[-1]),
+                "rows": int(len(times)),
+                "gaps": [
+                    [int(times[i]) + self.interval_ms, int(times[i + 1]) - self.interval_ms]
+                    for i in holes
+                ],
+            }
+        self.save()
+        return self
+
+    def save(self):
+        self.store.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps(
+                {
+                    "months": self.months,
+                    "covered": self.covered(),
+                    "gaps": self.gaps(),
+                    "checked": self.checked,
+                }
+            )
+        )
+        tmp.replace(self.path)
+
+    def covered(self) -> List[Range]:
+        if not self.months:
+            return []
+        summaries = [self.months[i] for i in sorted(self.months)]
+        start, end = summaries[0]["first"], summaries[-1]["last"]
+        return subtract_ranges([(start, end)], self._all_gaps())
+
+    def gaps(self) -> List[Range]:
+        """Holes between the first and last bar not yet checked against the exchange"""
+        return subtract_ranges(self._all_gaps(), self.checked)
+
+    def missing(self, start_ms: int, end_ms: int) -> List[Range]:
+        """Every range of [start_ms, end_ms] that should be fetched"""
+        wanted = [(start_ms, end_ms)]
+        missing = subtract_ranges(wanted, self.covered()) if self.months else wanted
+        return subtract_ranges(missing, self.checked)
+
+    def mark_checked(self, ranges: List[Range]):
+        self.checked = merge_ranges(self.checked + list(ranges), self.interval_ms)
+        self.save()
+
+    def _all_gaps(self) -> List[Range]:
+        gaps: List[Range] = []
+        previous_last = None
+        for month in sorted(self.months):
+            summary = self.months[month]
+            if (
+                previous_last is not None
+                and summary["first"] - previous_last > self.interval_ms
+            ):
+                gaps.append(
+                    (previous_last + self.interval_ms, summary["first"] - self.interval_ms)
+                )
+            gaps += [tuple(i) for i in summary["gaps"]]
+            previous_last = summary["last"]
+        return gaps
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from config import kline_cache_max_bytes, kline_cache_path, logging
+
+
+class KLinePageCache:
+    """On-disk cache of raw kline pages, keyed by (symbol, interval, startTime, limit).
+
+    Only closed pages are stored: a full page whose last kline closed before
+    now can never change. The trailing page (short, or still containing the
+    open kline) is always refetched. Reads bump the file mtime and the least
+    recently used pages are evicted once the cache grows past ``max_bytes``.
+    """
+
+    def __init__(self, root: Path = kline_cache_path, max_bytes: int = kline_cache_max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size: Optional[int] = None
+
+    @staticmethod
+    def key(symbol: str, interval: str, start_time_ms: int, limit: int) -> str:
+        return hashlib.sha256(
+            f"{symbol}|{interval}|{start_time_ms}|{limit}".encode()
+        ).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.root.joinpath(key[:2], f"{key}.json")
+
+    def get(
+        self, symbol: str, interval: str, start_time_ms: int, limit: int
+    ) -> Optional[List[list]]:
+        path = self.path(self.key(symbol, interval, start_time_ms, limit))
+        try:
+            raw = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    def put(
+        self,
+        symbol: str,
+        interval: str,
+        start_time_ms: int,
+        limit: int,
+        raw: bytes,
+        data: List[list],
+    ):
+        if not self.is_closed(data, limit):
+            return
+        path = self.path(self.key(symbol, interval, start_time_ms, limit))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(raw)
+        tmp.replace(path)
+        if self._size is None:
+            self._size = self._disk_usage()
+        else:
+            self._size += len(raw)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    @staticmethod
+    def is_closed(data: List[list], limit: int) -> bool:
+        return len(data) == limit and data[-1][6] < time.time() * 1000
+
+    def evict(self, target_ratio: float = 0.9):
+        """Drop the least recently used pages down to target_ratio of max_bytes"""
+        files = [(i.stat(), i) for i in self.root.glob("*/*.json")]
+        files.sort(key=lambda i: i[0].st_mtime)
+        size = sum(stat.st_size for stat, _ in files)
+        removed = 0
+        for stat, file in files:
+            if size <= self.max_bytes * target_ratio:
+                break
+            file.unlink(missing_ok=True)
+            size -= stat.st_size
+            removed += 1
+        self._size = size
+        logging.info(f"Kline cache: evicted {removed} pages, {size} bytes left")
+
+    def _disk_usage(self) -> int:
+        return sum(i.stat().st_size for i in self.root.glob("*/*.json"))
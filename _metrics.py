@@ -0,0 +1,153 @@
+"""In-process counters, gauges and histograms served in the Prometheus text format.
+
+    python populate_price_by_minutes.py    # then: curl http://127.0.0.1:9108/metrics
+
+The ingestion scripts start the endpoint on metrics_port (0 disables it).
+Metrics only live in the process that records them, so the multiprocessing
+Pool path of populate_price_by_minutes.py is not covered.
+"""
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from config import logging, metrics_host, metrics_port
+
+LabelValues = Tuple[str, ...]
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[i]) for i in self.labels)
+
+    def _format_labels(self, key: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labels, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        return super().render() + [
+            f"{self.name}{self._format_labels(k)} {v}" for k, v in sorted(self.values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+    default_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = default_buckets,
+    ):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] = self.sums.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(
+                    f"{self.name}_bucket{self._format_labels(key, ('le', le))} {total}"
+                )
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {self.sums[key]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {total}")
+        return lines
+
+
+registry: List[_Metric] = []
+
+binance_requests = Counter(
+    "binance_requests_total", "Kline requests by response status", ("status",)
+)
+binance_page_latency = Histogram(
+    "binance_page_latency_seconds", "Time from sending a kline request to its parsed page"
+)
+binance_cache_hits = Counter("binance_cache_hits_total", "Kline pages served from the page cache")
+backoff_sleep = Counter(
+    "binance_backoff_sleep_seconds_total",
+    "Seconds spent waiting, on the rate limiter or before a retry",
+    ("reason",),
+)
+store_rows_written = Counter("store_rows_written_total", "Rows appended to a store", ("store",))
+store_bytes_written = Counter(
+    "store_bytes_written_total", "Bytes written to disk by a store", ("store",)
+)
+store_latest_time = Gauge(
+    "store_latest_open_time_seconds", "Latest open time written to a store", ("store",)
+)
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(
+    host: str = metrics_host, port: int = metrics_port
+) -> Optional[web.AppRunner]:
+    """Serve /metrics on the running event loop, returns None when disabled"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logging.warning(f"Metrics endpoint not started on {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,114 @@
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from _store import ChunkedStore, minute_frame_names
+
+# How each minute column is folded into a bar
+bar_aggregations = {
+    "open": "first",
+    "high": "max",
+    "low": "min",
+    "close": "last",
+    "volume": "sum",
+    "quote_volume": "sum",
+    "trades": "sum",
+    "taker_base_volume": "sum",
+    "taker_quote_volume": "sum",
+}
+
+Bars = Tuple[np.ndarray, Dict[str, np.ndarray]]
+
+
+def interval_ms(interval: str) -> int:
+    """"720min" -> 43200000"""
+    return int(pd.Timedelta(interval).total_seconds() * 1000)
+
+
+def _reduce_bins(bins: np.ndarray, columns: Dict[str, np.ndarray]) -> Bars:
+    """Aggregate rows sharing a bin, ``bins`` must be sorted"""
+    starts = np.flatnonzero(np.append(True, bins[1:] != bins[:-1]))
+    ends = np.append(starts[1:], len(bins)) - 1
+    out = {}
+    for c, how in bar_aggregations.items():
+        values = columns[c]
+        if how == "first":
+            out[c] = values[starts]
+        elif how == "last":
+            out[c] = values[ends]
+        elif how == "max":
+            out[c] = np.maximum.reduceat(values, starts)
+        elif how == "min":
+            out[c] = np.minimum.reduceat(values, starts)
+        else:
+            out[c] = np.add.reduceat(values, starts)
+    return bins[starts], out
+
+
+class MultiResampler:
+    """Folds minute bars into OHLCV bars of several intervals in a single pass.
+
+    Bars are anchored on ``origin_ms`` and labelled with their open time.
+    Chunks must be fed in time order; each chunk is reduced on its own and
+    the partial bars of a bar that spans two chunks are merged at the end,
+    so only one chunk of minutes is in memory at a time.
+    """
+
+    def __init__(self, intervals: Iterable[str], origin_ms: int):
+        self.intervals = list(intervals)
+        self.origin_ms = origin_ms
+        self._partials: Dict[str, List[Bars]] = {i: [] for i in self.intervals}
+
+    def update(self, minutes: Dict[str, np.ndarray]):
+        times = np.asarray(minutes["open_time"])
+        if not len(times):
+            return
+        columns = {c: np.asarray(minutes[c], dtype=np.float64) for c in bar_aggregations}
+        for interval in self.intervals:
+            bins = (times - self.origin_ms) // interval_ms(interval)
+            self._partials[interval].append(_reduce_bins(bins, columns))
+
+    def bars(self, interval: str, start_ms: int, end_ms: int) -> pd.DataFrame:
+        """Bars opening in [start_ms, end_ms], NaN where there were no minutes.
+
+        "Open time" stays in epoch milliseconds like the minute store.
+        """
+        step = interval_ms(interval)
+        first = -(-(start_ms - self.origin_ms) // step)
+        last = (end_ms - self.origin_ms) // step
+        grid = np.arange(first, last + 1)
+        frame = {minute_frame_names["open_time"]: self.origin_ms + grid * step}
+        partials = self._partials[interval]
+        if partials:
+            bins, columns = _reduce_bins(
+                np.concatenate([b for b, _ in partials]),
+                {c: np.concatenate([p[c] for _, p in partials]) for c in bar_aggregations},
+            )
+            keep = (bins >= first) & (bins <= last)
+            position = bins[keep] - first
+        for c in bar_aggregations:
+            values = np.full(len(grid), np.nan)
+            if partials:
+                values[position] = columns[c][keep]
+            frame[minute_frame_names[c]] = values
+        return pd.DataFrame(frame)
+
+
+def resample_store(
+    store: ChunkedStore,
+    intervals: Iterable[str],
+    start_ms: int,
+    end_ms: int,
+    origin_ms: int,
+) -> Dict[str, pd.DataFrame]:
+    """Read the store once and return one bar frame per interval"""
+    resampler = MultiResampler(intervals, origin_ms)
+    columns = ["open_time", "ignore"] + list(bar_aggregations)
+    for chunk in store.iter_months(columns, start_ms, end_ms):
+        valid = chunk["ignore"] == 0
+        resampler.update({c: chunk[c][valid] for c in columns})
+    return {
+        interval: resampler.bars(interval, start_ms, end_ms)
+        for interval in resampler.intervals
+    }
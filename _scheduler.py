@@ -0,0 +1,163 @@
+"""Runs per-pair jobs on a process pool, largest first, within a memory budget.
+
+Each job carries a cost, used to order the jobs so the long ones do not
+start last, and the bytes it is expected to hold. A job starts once a worker
+is free and the running jobs leave room for it in the budget; a job larger
+than the whole budget runs alone. Workers are replaced after every job, so
+the memory a job held goes back to the system; the timing summary printed at
+the end shows how far each job raised its worker's peak RSS next to the
+estimate.
+
+A worker killed mid-job (by the OOM killer, say) never returns its result,
+so every worker reports the job it starts and its pid: a job whose worker
+is gone without a result is reported as failed instead of waited on.
+"""
+import multiprocessing
+import os
+import queue
+import resource
+import time
+from multiprocessing import Pool
+from traceback import format_exception
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from config import logging, pool_memory_budget_mb
+
+mb = 1 << 20
+# how often the running jobs' workers are checked while no job finishes
+poll_seconds = 1.0
+
+
+class Job(NamedTuple):
+    name: str
+    item: Any
+    cost: float
+    memory: int
+
+
+class JobTiming(NamedTuple):
+    name: str
+    seconds: float
+    memory: int
+    rss_growth: int
+    ok: bool
+
+
+def _peak_rss() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+_started: "multiprocessing.SimpleQueue"
+
+
+def _init_worker(started: "multiprocessing.SimpleQueue"):
+    global _started
+    _started = started
+
+
+def _timed(function: Callable, name: str, item: Any) -> Tuple[Any, float, int]:
+    """Result, seconds and how far the job raised the worker's peak RSS"""
+    _started.put((name, os.getpid()))
+    baseline = _peak_rss()
+    started = time.perf_counter()
+    result = function(item)
+    return result, time.perf_counter() - started, _peak_rss() - baseline
+
+
+def run_jobs(
+    function: Callable,
+    jobs: Iterable[Job],
+    pool_size: int,
+    memory_budget: int = pool_memory_budget_mb * mb,
+) -> Dict[str, Any]:
+    """Call ``function(job.item)`` for every job, returns the results by job name"""
+    pending = sorted(jobs, key=lambda j: -j.cost)
+    running: Dict[str, Tuple[Job, float]] = {}
+    finished: "queue.Queue[Tuple[str, bool, Any]]" = queue.Queue()
+    # written straight to the pipe, a worker killed right after still reported
+    workers = multiprocessing.SimpleQueue()
+    pids: Dict[str, int] = {}
+    gone: Dict[str, int] = {}
+    results: Dict[str, Any] = {}
+    timings: List[JobTiming] = []
+    started = time.perf_counter()
+    with Pool(pool_size, _init_worker, (workers,), maxtasksperchild=1) as pool:
+        while pending or running:
+            while pending and len(running) < pool_size:
+                used = sum(job.memory for job, _ in running.values())
+                job = pending[0]
+                if running and used + job.memory > memory_budget:
+                    break
+                pending.pop(0)
+                running[job.name] = (job, time.perf_counter())
+                pool.apply_async(
+                    _timed,
+                    (function, job.name, job.item),
+                    callback=lambda r, name=job.name: finished.put((name, True, r)),
+                    error_callback=lambda e, name=job.name: finished.put((name, False, e)),
+                )
+            try:
+                name, ok, outcome = finished.get(timeout=poll_seconds)
+            except queue.Empty:
+                name = _dead_job(running, workers, pids, gone)
+                if name is None:
+                    continue
+                ok = False
+                outcome = RuntimeError(
+                    f"worker {pids[name]} exited without a result (killed, out of memory?)"
+                )
+            pids.pop(name, None)
+            gone.pop(name, None)
+            job, job_started = running.pop(name)
+            if ok:
+                results[name], seconds, rss_growth = outcome
+            else:
+                trace = format_exception(type(outcome), outcome, outcome.__traceback__)
+                logging.error(f"{name} | {''.join(trace)}")
+                seconds, rss_growth = time.perf_counter() - job_started, 0
+            timings.append(JobTiming(name, seconds, job.memory, rss_growth, ok))
+    log_timings(timings, time.perf_counter() - started)
+    return results
+
+
+def _dead_job(
+    running: Dict[str, Tuple[Job, float]],
+    workers: "multiprocessing.SimpleQueue",
+    pids: Dict[str, int],
+    gone: Dict[str, int],
+) -> Optional[str]:
+    """A running job whose worker is gone, None if there is none.
+
+    A worker sends its result before it exits, so a job only counts once
+    its worker has been gone for two checks in a row with no result.
+    """
+    while not workers.empty():
+        name, pid = workers.get()
+        pids[name] = pid
+    for name, pid in pids.items():
+        if name not in running:
+            continue
+        try:
+            os.kill(pid, 0)
+            gone.pop(name, None)
+        except ProcessLookupError:
+            gone[name] = gone.get(name, 0) + 1
+            if gone[name] > 1:
+                return name
+    return None
+
+
+def log_timings(timings: List[JobTiming], wall_seconds: float):
+    lines = [f"{'job':<24}{'seconds':>10}{'estimated MB':>14}{'RSS growth MB':>15}"]
+    for t in sorted(timings, key=lambda t: -t.seconds):
+        lines.append(
+            f"{t.name:<24}{t.seconds:>10.1f}{t.memory / mb:>14.0f}{t.rss_growth / mb:>15.0f}"
+            + ("" if t.ok else "  failed")
+        )
+    busy = sum(t.seconds for t in timings)
+    lines.append(
+        f"{len(timings)} jobs in {wall_seconds:.1f}s, {busy:.1f}s of work "
+        f"({busy / max(wall_seconds, 1e-9):.1f} workers busy on average)"
+    )
+    logging.info("Job timings\n" + "\n".join(lines))
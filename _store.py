@@ -0,0 +1,405 @@
+import io
+import os
+import shutil
+import zipfile
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from _metrics import store_bytes_written, store_latest_time, store_rows_written
+from config import (
+    minute_store_compress_sealed,
+    minute_store_flush_rows,
+    price_by_minutes_path,
+)
+
+minute_columns = {
+    "open_time": np.int64,
+    "open": np.float64,
+    "high": np.float64,
+    "low": np.float64,
+    "close": np.float64,
+    "volume": np.float64,
+    "close_time": np.int64,
+    "quote_volume": np.float64,
+    "trades": np.int64,
+    "taker_base_volume": np.float64,
+    "taker_quote_volume": np.float64,
+    "ignore": np.float64,
+}
+
+# Column names used by the pandas stages (same as the old csv header)
+minute_frame_names = {
+    "open_time": "Open time",
+    "open": "Open",
+    "high": "High",
+    "low": "Low",
+    "close": "Close",
+    "volume": "Volume",
+    "close_time": "Close time",
+    "quote_volume": "Quote asset volume",
+    "trades": "Number of trades",
+    "taker_base_volume": "Taker buy base asset volume",
+    "taker_quote_volume": "Taker buy quote asset volume",
+    "ignore": "Ignore",
+}
+
+
+def epoch_ms(date) -> int:
+    """Open time key of a datetime, naive datetimes are taken as UTC"""
+    return int(pd.Timestamp(date).value // 1_000_000)
+
+
+def month_keys(timestamps_ms: np.ndarray) -> np.ndarray:
+    return timestamps_ms.astype("datetime64[ms]").astype("datetime64[M]").astype(str)
+
+
+class ChunkedStore:
+    """Columnar store split in one chunk per calendar month.
+
+    The month being written lives in ``<root>/<YYYY-MM>/<column>.npy`` and is
+    read memory-mapped. Once a later month exists, a month is sealed into a
+    compressed ``<root>/<YYYY-MM>.npz`` (unless compress_sealed is False, in
+    which case every month stays memory-mappable). Rows are kept sorted and
+    unique on ``time_column``.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        schema: Dict[str, type],
+        time_column: str = "open_time",
+        compress_sealed: bool = minute_store_compress_sealed,
+    ):
+        self.root = root
+        self.schema = schema
+        self.time_column = time_column
+        self.compress_sealed = compress_sealed
+        self._recovered = False
+
+    @property
+    def name(self) -> str:
+        return self.root.name
+
+    def exists(self) -> bool:
+        return self.root.exists() and bool(self.months())
+
+    def months(self) -> List[str]:
+        if not self.root.exists():
+            return []
+        months = set()
+        for item in self.root.iterdir():
+            name = item.stem if item.suffix == ".npz" else item.name
+            # skips the .tmp / .old leftovers of an interrupted write
+            if len(name) == 7 and name[4] == "-":
+                months.add(name)
+        return sorted(months)
+
+    def read_month(
+        self, month: str, columns: Optional[Iterable[str]] = None
+    ) -> Dict[str, np.ndarray]:
+        columns = list(columns or self.schema)
+        chunk_dir = self.root.joinpath(month)
+        if chunk_dir.is_dir():
+            # a column can be ahead of the time column while an append is
+            # writing its headers, the time column holds the row count
+            rows = np.load(chunk_dir.joinpath(f"{self.time_column}.npy"), mmap_mode="r").shape[0]
+            return {
+                c: np.load(chunk_dir.joinpath(f"{c}.npy"), mmap_mode="r")[:rows]
+                for c in columns
+            }
+        with np.load(self.root.joinpath(f"{month}.npz")) as chunk:
+            return {c: chunk[c] for c in columns}
+
+    def nbytes(self) -> int:
+        """Size of all the columns once loaded, without reading them"""
+        total = 0
+        for month in self.months():
+            chunk_dir = self.root.joinpath(month)
+            if chunk_dir.is_dir():
+                total += sum(f.stat().st_size for f in chunk_dir.glob("*.npy"))
+            else:
+                with zipfile.ZipFile(self.root.joinpath(f"{month}.npz")) as chunk:
+                    total += sum(i.file_size for i in chunk.infolist())
+        return total
+
+    def month_signature(self, month: str) -> str:
+        """Changes whenever the month chunk is rewritten"""
+        chunk_dir = self.root.joinpath(month)
+        if chunk_dir.is_dir():
+            stat = chunk_dir.joinpath(f"{self.time_column}.npy").stat()
+        else:
+            stat = self.root.joinpath(f"{month}.npz").stat()
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    def iter_months(
+        self,
+        columns: Optional[Iterable[str]] = None,
+        start_ms: Optional[int] = None,
+        end_ms: Optional[int] = None,
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """Yield the rows with ``start_ms <= time <= end_ms`` one month at a time"""
+        columns = list(columns or self.schema)
+        wanted = list(dict.fromkeys([self.time_column] + columns))
+        months = self.months()
+        if start_ms is not None:
+            months = [i for i in months if i >= str(month_keys(np.array([start_ms]))[0])]
+        if end_ms is not None:
+            months = [i for i in months if i <= str(month_keys(np.array([end_ms]))[0])]
+        for month in months:
+            chunk = self.read_month(month, wanted)
+            times = chunk[self.time_column]
+            lo = 0 if start_ms is None else np.searchsorted(times, start_ms, "left")
+            hi = len(times) if end_ms is None else np.searchsorted(times, end_ms, "right")
+            yield {c: chunk[c][lo:hi] for c in columns}
+
+    def read(
+        self,
+        columns: Optional[Iterable[str]] = None,
+        start_ms: Optional[int] = None,
+        end_ms: Optional[int] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Return the rows with ``start_ms <= time <= end_ms``"""
+        columns = list(columns or self.schema)
+        parts: Dict[str, List[np.ndarray]] = {c: [] for c in columns}
+        for chunk in self.iter_months(columns, start_ms, end_ms):
+            for c in columns:
+                parts[c].append(chunk[c])
+        return {
+            c: np.concatenate(parts[c])
+            if parts[c]
+            else np.empty(0, dtype=self.schema[c])
+            for c in columns
+        }
+
+    def first_time(self) -> Optional[int]:
+        months = self.months()
+        if not months:
+            return None
+        times = self.read_month(months[0], [self.time_column])[self.time_column]
+        return int(times[0]) if len(times) else None
+
+    def last_time(self) -> Optional[int]:
+        months = self.months()
+        if not months:
+            return None
+        times = self.read_month(months[-1], [self.time_column])[self.time_column]
+        return int(times[-1]) if len(times) else None
+
+    def recover(self):
+        """Finish or undo the month rewrites an interrupted writer left behind.
+
+        _write_month moves the old chunk to ``<month>.old`` before moving the
+        new one in; when the process died in between, the old chunk is put
+        back (the rows of the rewrite are fetched again, as for any crash).
+        Leftover ``.old`` and ``.tmp`` copies are removed.
+        """
+        self._recovered = True
+        if not self.root.exists():
+            return
+        for item in self.root.iterdir():
+            if item.suffix == ".old":
+                final = self.root.joinpath(item.stem)
+                if final.exists():
+                    shutil.rmtree(item)
+                else:
+                    os.replace(item, final)
+        for item in self.root.iterdir():
+            if item.name.endswith(".tmp"):
+                shutil.rmtree(item)
+            elif item.name.endswith(".tmp.npz"):
+                item.unlink()
+
+    def append(self, data: Dict[str, np.ndarray]):
+        """Merge rows into their month chunks, the newest row wins on duplicates"""
+        if not self._recovered:
+            self.recover()
+        times = np.asarray(data[self.time_column], dtype=np.int64)
+        if not len(times):
+            return
+        keys = month_keys(times)
+        existing = set(self.months())
+        for month in np.unique(keys):
+            mask = keys == month
+            new = {
+                c: np.asarray(data[c], dtype=dtype)[mask]
+                for c, dtype in self.schema.items()
+            }
+            written = sum(v.nbytes for v in new.values())
+            if not (month in existing and self._append_in_place(month, new)):
+                if month in existing:
+                    old = self.read_month(month)
+                    new = {c: np.concatenate([old[c], new[c]]) for c in self.schema}
+                new = self._sorted_unique(new)
+                self._write_month(month, new)
+                written = sum(v.nbytes for v in new.values())
+            store_bytes_written.inc(written, store=self.name)
+        store_rows_written.inc(len(times), store=self.name)
+        latest = store_latest_time.values.get((self.name,), 0)
+        store_latest_time.set(max(latest, int(times.max()) / 1000), store=self.name)
+        if self.compress_sealed:
+            months = self.months()
+            for month in months[:-1]:
+                if self.root.joinpath(month).is_dir():
+                    self.seal(month)
+
+    def seal(self, month: str):
+        chunk_dir = self.root.joinpath(month)
+        chunk = {c: np.array(v) for c, v in self.read_month(month).items()}
+        tmp = self.root.joinpath(f"{month}.tmp.npz")
+        np.savez_compressed(tmp, **chunk)
+        store_bytes_written.inc(tmp.stat().st_size, store=self.name)
+        os.replace(tmp, self.root.joinpath(f"{month}.npz"))
+        shutil.rmtree(chunk_dir)
+
+    def writer(self, flush_rows: int = minute_store_flush_rows) -> "StoreWriter":
+        return StoreWriter(self, flush_rows)
+
+    def _sorted_unique(self, data: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        times = data[self.time_column]
+        # stable sort keeps arrival order, so the last occurrence is the newest
+        order = np.argsort(times, kind="stable")
+        times = times[order]
+        keep = np.append(times[1:] != times[:-1], True)
+        return {c: v[order][keep] for c, v in data.items()}
+
+    def _append_in_place(self, month: str, data: Dict[str, np.ndarray]) -> bool:
+        """Append rows at the end of an open month chunk without rewriting it.
+
+        Only possible when the new rows are sorted, all later than the chunk's
+        last row, and every .npy header keeps its length once the row count
+        grows (numpy pads headers for this). The time column's header is
+        the row count of the chunk: every file is cut back to it before the
+        rows are added, which drops what an append interrupted before its
+        headers were written left behind.
+        """
+        chunk_dir = self.root.joinpath(month)
+        times = data[self.time_column]
+        if not chunk_dir.is_dir() or (np.diff(times) <= 0).any():
+            return False
+        old_times = self.read_month(month, [self.time_column])[self.time_column]
+        rows = len(old_times)
+        if rows and times[0] <= old_times[-1]:
+            return False
+        headers = {}
+        for c in self.schema:
+            with open(chunk_dir.joinpath(f"{c}.npy"), "rb") as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    read_header = np.lib.format.read_array_header_1_0
+                    write_header = np.lib.format.write_array_header_1_0
+                else:
+                    read_header = np.lib.format.read_array_header_2_0
+                    write_header = np.lib.format.write_array_header_2_0
+                shape, fortran_order, file_dtype = read_header(f)
+                offset = f.tell()
+            if shape[0] < rows:
+                return False
+            header = io.BytesIO()
+            write_header(
+                header,
+                {
+                    "descr": np.lib.format.dtype_to_descr(file_dtype),
+                    "fortran_order": fortran_order,
+                    "shape": (rows + len(times),),
+                },
+            )
+            if len(header.getvalue()) != offset:
+                return False
+            headers[c] = (header.getvalue(), offset + rows * file_dtype.itemsize)
+        for c, dtype in self.schema.items():
+            with open(chunk_dir.joinpath(f"{c}.npy"), "r+b") as f:
+                f.truncate(headers[c][1])
+                f.seek(headers[c][1])
+                f.write(np.ascontiguousarray(data[c], dtype=dtype).tobytes())
+        # headers last, the time column's at the very end: until then
+        # readers and the next append still see the old row count
+        for c in sorted(self.schema, key=lambda c: c == self.time_column):
+            with open(chunk_dir.joinpath(f"{c}.npy"), "r+b") as f:
+                f.write(headers[c][0])
+        return True
+
+    def _write_month(self, month: str, data: Dict[str, np.ndarray]):
+        self.root.mkdir(parents=True, exist_ok=True)
+        final = self.root.joinpath(month)
+        tmp = self.root.joinpath(f"{month}.tmp")
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir()
+        for c, values in data.items():
+            np.save(tmp.joinpath(f"{c}.npy"), np.ascontiguousarray(values))
+        if final.exists():
+            old = self.root.joinpath(f"{month}.old")
+            os.replace(final, old)
+            os.replace(tmp, final)
+            shutil.rmtree(old)
+        else:
+            os.replace(tmp, final)
+        sealed = self.root.joinpath(f"{month}.npz")
+        if sealed.exists():
+            sealed.unlink()
+
+
+class StoreWriter:
+    """Buffers appended pages and writes them once a month rolls or the buffer fills"""
+
+    def __init__(self, store: ChunkedStore, flush_rows: int):
+        self.store = store
+        self.flush_rows = flush_rows
+        self.rows_written = 0
+        self._pending: List[Dict[str, np.ndarray]] = []
+        self._pending_rows = 0
+        self._pending_month: Optional[str] = None
+
+    def write(self, data: Dict[str, np.ndarray]):
+        times = data[self.store.time_column]
+        if not len(times):
+            return
+        last_month = str(month_keys(np.asarray(times[-1:]))[0])
+        if self._pending_month is not None and last_month != self._pending_month:
+            self.flush()
+        self._pending.append(data)
+        self._pending_rows += len(times)
+        self._pending_month = last_month
+        if self._pending_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self.store.append(
+            {
+                c: np.concatenate([i[c] for i in self._pending])
+                for c in self.store.schema
+            }
+        )
+        self.rows_written += self._pending_rows
+        self._pending = []
+        self._pending_rows = 0
+        self._pending_month = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def minute_store(currency_pair: str, root: Path = price_by_minutes_path) -> ChunkedStore:
+    return ChunkedStore(root.joinpath(currency_pair), minute_columns)
+
+
+def read_minutes_frame(
+    store: ChunkedStore,
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+    columns: Optional[Iterable[str]] = None,
+) -> pd.DataFrame:
+    data = store.read(columns, start_ms, end_ms)
+    frame = pd.DataFrame({minute_frame_names[c]: v for c, v in data.items()})
+    for c in ("Open time", "Close time"):
+        if c in frame.columns:
+            frame[c] = pd.to_datetime(frame[c], unit="ms")
+    return frame
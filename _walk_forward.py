@@ -0,0 +1,257 @@
+"""Training windows of one pair for every work date of a walk-forward run.
+
+The feature file is read once for the whole period, through the parsed
+feature cache (_feature_cache.py), so a rerun over unchanged files does not
+parse them at all. A single date (the daily run) reads only the months its
+windows span instead: the file was appended to since the day before, and
+through the cache it would be parsed whole again. Each work date then takes
+its train, validation and test windows as index ranges of that one matrix,
+instead of re-reading the file and rebuilding every window. The scaler is
+still fit per date on that date's training rows, so only the rows the
+date's windows span are scaled before the windows are taken as strided
+views of them.
+"""
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from numpy.lib.stride_tricks import sliding_window_view
+from sklearn.preprocessing import StandardScaler
+
+from _feature_cache import feature_cache
+from _feature_files import read_features, time_column
+from _store import epoch_ms
+from config import (
+    X_period,
+    feature_dtype,
+    minimum_length_of_days_for_validation_testing,
+    mins,
+    period,
+    target_column,
+    x_columns,
+)
+
+train_period = relativedelta(months=2)
+# the validation windows start this many bars before their dates
+validation_offset = 6
+
+
+class TrainingDates(NamedTuple):
+    start_train: datetime
+    end_train: datetime
+    start_validation: datetime
+    end_validation: datetime
+    start_test: datetime
+    end_test: datetime
+
+
+def training_dates(work_date: datetime) -> TrainingDates:
+    end_validation = work_date - timedelta(days=1)
+    start_validation = end_validation - timedelta(
+        days=minimum_length_of_days_for_validation_testing
+    )
+    return TrainingDates(
+        start_train=start_validation - train_period,
+        end_train=start_validation - timedelta(days=1),
+        start_validation=start_validation,
+        end_validation=end_validation,
+        start_test=work_date - timedelta(days=minimum_length_of_days_for_validation_testing),
+        end_test=work_date,
+    )
+
+
+class WalkForwardData:
+    """x_columns of one feature file from the first to the last work date"""
+
+    def __init__(self, filename: Path, first_date: datetime, last_date: datetime):
+        if first_date == last_date:
+            start_ms, end_ms = self._bounds(first_date, last_date)
+            data = read_features(filename, start_ms, end_ms, x_columns)
+            times = data[time_column].to_numpy(np.int64)
+            values = data[x_columns].to_numpy(np.float64)
+        else:
+            times, values = feature_cache.get(filename, x_columns)
+        self._take(filename.name, times, values, first_date, last_date)
+
+    @classmethod
+    def from_frame(
+        cls, name: str, data: pd.DataFrame, first_date: datetime, last_date: datetime
+    ) -> "WalkForwardData":
+        """The same rows taken from features built in memory"""
+        self = cls.__new__(cls)
+        times = data["Open time"].to_numpy(np.int64)
+        self._take(name, times, data[x_columns].to_numpy(np.float64), first_date, last_date)
+        return self
+
+    def _take(
+        self,
+        name: str,
+        times: np.ndarray,
+        values: np.ndarray,
+        first_date: datetime,
+        last_date: datetime,
+    ):
+        start_ms, end_ms = self._bounds(first_date, last_date)
+        rows = slice(
+            int(np.searchsorted(times, start_ms)),
+            int(np.searchsorted(times, end_ms, side="right")),
+        )
+        self.name = name
+        # views of the mapped cache entry, of the rows read or of the frame
+        self.times = times[rows]
+        self.values = values[rows]
+        # the target is not scaled
+        self.scaled = np.array([c != target_column for c in x_columns])
+        self.target = x_columns.index(target_column)
+
+    @staticmethod
+    def _bounds(first_date: datetime, last_date: datetime) -> Tuple[int, int]:
+        """Open times of the first and last rows the windows of the dates may use"""
+        # a period of bars to spare on both sides of the windows
+        margin = timedelta(minutes=period * mins)
+        return (
+            epoch_ms(training_dates(first_date).start_train - margin),
+            epoch_ms(last_date + margin),
+        )
+
+    def _rows(self, start_ms: int, end_ms: int) -> slice:
+        """Rows with start_ms <= Open time <= end_ms"""
+        return slice(
+            int(np.searchsorted(self.times, start_ms, side="left")),
+            int(np.searchsorted(self.times, end_ms, side="right")),
+        )
+
+    def window_range(self, start_date: datetime, end_date: datetime) -> Tuple[int, int]:
+        """Rows of the first and last window starting from start_date whose
+        target still ends by end_date"""
+        delta = timedelta(minutes=(period - 1) * mins)
+        first = self._rows(epoch_ms(start_date), epoch_ms(start_date))
+        last = self._rows(epoch_ms(end_date - delta), epoch_ms(end_date - delta))
+        if first.start == first.stop or last.start == last.stop:
+            raise KeyError(f"{self.name} has no bar at {start_date} or {end_date - delta}")
+        # on a repeated open time, start after the first and end at the last
+        return first.stop if first.stop - first.start > 1 else first.start, last.start
+
+    def _ranges(self, work_date: datetime) -> List[Tuple[Tuple[int, int], int]]:
+        """First and last rows of the train, validation and test windows, with their k"""
+        dates = training_dates(work_date)
+        return [
+            (self.window_range(dates.start_train, dates.end_train), 0),
+            (
+                self.window_range(dates.start_validation, dates.end_validation),
+                validation_offset,
+            ),
+            (self.window_range(dates.start_test, dates.end_test), 0),
+        ]
+
+    def sample_counts(self, work_date: datetime) -> Tuple[int, int, int]:
+        """Number of train, validation and test windows of work_date"""
+        train, valid, test = (last - first + 1 for (first, last), _ in self._ranges(work_date))
+        return train, valid, test
+
+    def windows(
+        self, work_date: datetime, dtype: str = feature_dtype
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """(x, y) of the train, validation and test sets of work_date, as
+        ``dtype`` views of the rows they span, scaled for that date.
+
+        Sample i is rows i - k .. i + X_period - k of every column, transposed,
+        and the target of rows i + X_period .. i + period; k is
+        validation_offset for the validation set and 0 otherwise.
+        """
+        dates = training_dates(work_date)
+        ranges = self._ranges(work_date)
+        begin = min(first - k for (first, _), k in ranges)
+        stop = max(last + period for (_, last), _ in ranges)
+        if begin < 0 or stop > len(self.values):
+            raise ValueError(
+                f"{self.name} | windows of rows {begin} to {stop} fall outside "
+                f"the {len(self.values)} rows loaded"
+            )
+
+        fit = self._rows(epoch_ms(dates.start_train), epoch_ms(dates.end_train))
+        scaler = StandardScaler().fit(self.values[fit][:, self.scaled])
+        # scaled in float64 (a price is large next to its spread), the windows
+        # repeat every row X_period times and are built in dtype
+        block = self.values[begin:stop].copy()
+        block[:, self.scaled] = scaler.transform(block[:, self.scaled])
+        block = block.astype(dtype)
+        # (rows - X_period + 1, features, X_period): window j holds rows j .. j + X_period - 1
+        x_windows = sliding_window_view(block, X_period, axis=0)
+        y_windows = sliding_window_view(
+            np.ascontiguousarray(block[:, self.target]), period - X_period
+        )
+        views = []
+        for (first, last), k in ranges:
+            first, last = first - begin, last - begin
+            views.append(
+                (
+                    x_windows[first - k : last - k + 1],
+                    y_windows[first + X_period : last + X_period + 1],
+                )
+            )
+        return views
+
+    def splits(
+        self, work_date: datetime, dtype: str = feature_dtype
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """x_train, y_train, x_valid, y_valid, x_test of work_date as ``dtype`` arrays"""
+        (x_train, y_train), (x_valid, y_valid), (x_test, _) = self.windows(work_date, dtype)
+        return (
+            np.ascontiguousarray(x_train),
+            np.ascontiguousarray(y_train),
+            np.ascontiguousarray(x_valid),
+            np.ascontiguousarray(y_valid),
+            np.ascontiguousarray(x_test),
+        )
+
+
+class PairRows(NamedTuple):
+    name: str
+    train: slice  # rows of TrainingSet.X and .y
+    valid: slice  # rows of TrainingSet.X and .y, after every pair's train rows
+    test: slice  # rows of TrainingSet.x_test
+
+
+class TrainingSet(NamedTuple):
+    X: np.ndarray  # the train windows of every pair, then the validation ones
+    y: np.ndarray
+    x_test: np.ndarray
+    splits: Tuple[List[int], List[int]]  # train and validation rows of X
+    pairs: List[PairRows]
+
+
+def assemble_training_set(
+    datasets: List[WalkForwardData], work_date: datetime, dtype: str = feature_dtype
+) -> TrainingSet:
+    """Windows of every pair for work_date, copied once into buffers sized
+    from their counts"""
+    counts = [data.sample_counts(work_date) for data in datasets]
+    n_train = sum(train for train, _, _ in counts)
+    n_samples = n_train + sum(valid for _, valid, _ in counts)
+    X = np.empty((n_samples, len(x_columns), X_period), dtype=dtype)
+    y = np.empty((n_samples, period - X_period), dtype=dtype)
+    x_test = np.empty((sum(test for _, _, test in counts), len(x_columns), X_period), dtype=dtype)
+
+    pairs = []
+    train_at, valid_at, test_at = 0, n_train, 0
+    for data, (n_pair_train, n_pair_valid, n_pair_test) in zip(datasets, counts):
+        rows = PairRows(
+            data.name,
+            slice(train_at, train_at + n_pair_train),
+            slice(valid_at, valid_at + n_pair_valid),
+            slice(test_at, test_at + n_pair_test),
+        )
+        (x_train_s, y_train_s), (x_valid_s, y_valid_s), (x_test_s, _) = data.windows(
+            work_date, dtype
+        )
+        X[rows.train], y[rows.train] = x_train_s, y_train_s
+        X[rows.valid], y[rows.valid] = x_valid_s, y_valid_s
+        x_test[rows.test] = x_test_s
+        pairs.append(rows)
+        train_at, valid_at, test_at = rows.train.stop, rows.valid.stop, rows.test.stop
+    splits = (list(range(n_train)), list(range(n_train, n_samples)))
+    return TrainingSet(X, y, x_test, splits, pairs)
@@ -0,0 +1,122 @@
+"""Times the async minute ingestion against the local Binance stand-in.
+
+    python benchmark_ingestion.py --pairs 20 --days 30 --pages-in-flight 8 --latency-ms 40
+
+Nothing is sent to api.binance.com and the minute store is written to a
+temporary directory, so it can be run anywhere. The page cache is off
+unless --cache is given.
+"""
+import argparse
+import asyncio
+import socket
+import tempfile
+import time
+from datetime import timedelta
+from multiprocessing import Process
+from pathlib import Path
+
+from _binance import AsyncBinanceKLine, WeightRateLimiter
+from _binance_standin import StandInOptions, run_standin
+from _kline_cache import KLinePageCache
+from _list_of_currency_pairs import currency_pairs
+from _store import minute_store
+from config import (
+    binance_max_connections,
+    binance_weight_limit,
+    binance_weight_safety_margin,
+    end_date,
+    logging,
+    price_by_minutes_pages_in_flight,
+)
+from populate_price_by_minutes import ingest_range
+
+
+def wait_for_port(host: str, port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception(f"The stand-in did not start on {host}:{port}")
+
+
+async def run_benchmark(args, root: Path) -> dict:
+    pairs = currency_pairs[: args.pairs]
+    end_ms = int(end_date.timestamp()) * 1000
+    start_ms = end_ms - int(timedelta(days=args.days).total_seconds()) * 1000
+    limiter = WeightRateLimiter(args.weight_limit, args.safety_margin)
+    client = AsyncBinanceKLine(
+        limiter,
+        kline_url=f"http://{args.host}:{args.port}/api/v3/klines",
+        max_connections=args.connections,
+        use_cache=False,
+    )
+    if args.cache is not None:
+        client.cache = KLinePageCache(args.cache)
+    rows = 0
+
+    async def run_pair(pair: str):
+        nonlocal rows
+        with minute_store(pair, root).writer() as writer:
+            await ingest_range(
+                pair, client, writer, start_ms, end_ms, args.pages_in_flight
+            )
+        rows += writer.rows_written
+
+    started = time.perf_counter()
+    async with client:
+        await asyncio.gather(*(run_pair(pair) for pair in pairs))
+    elapsed = time.perf_counter() - started
+    return {
+        "pairs": len(pairs),
+        "pages": client.pages,
+        "rows": rows,
+        "retries": client.retries,
+        "cache_hits": client.cache.hits if client.cache else 0,
+        "rate_limiter_wait_s": round(limiter.waited_seconds, 3),
+        "elapsed_s": round(elapsed, 3),
+        "pages_per_s": round(client.pages / elapsed, 1),
+        "rows_per_s": round(rows / elapsed, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pairs", type=int, default=10)
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--pages-in-flight", type=int, default=price_by_minutes_pages_in_flight)
+    parser.add_argument("--connections", type=int, default=binance_max_connections)
+    parser.add_argument("--weight-limit", type=int, default=binance_weight_limit)
+    parser.add_argument("--safety-margin", type=float, default=binance_weight_safety_margin)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--rate-429", type=float, default=0)
+    parser.add_argument("--rate-418", type=float, default=0)
+    parser.add_argument("--recordings", type=Path, help="replay recorded pages")
+    parser.add_argument(
+        "--cache", type=Path, help="page cache directory, run twice to time a warm cache"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    args = parser.parse_args()
+
+    options = StandInOptions(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_429=args.rate_429,
+        rate_418=args.rate_418,
+        weight_limit=args.weight_limit,
+        recordings=args.recordings,
+    )
+    server = Process(target=run_standin, args=(options, args.host, args.port), daemon=True)
+    server.start()
+    try:
+        wait_for_port(args.host, args.port)
+        with tempfile.TemporaryDirectory() as root:
+            result = asyncio.run(run_benchmark(args, Path(root)))
+    finally:
+        server.terminate()
+    for key, value in result.items():
+        logging.info(f"{key:>20}: {value}")
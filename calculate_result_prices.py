@@ -6,6 +6,9 @@ from typing import cast
 import pandas as pd
 import numpy as np
 import logging
+from _feature_files import read_features
+from _resample import interval_ms
+from _store import epoch_ms
 from config import (
     training_output_path,
     result_prices_path,
@@ -52,16 +55,14 @@ def main():
             )
 
             # load the data file where you can see the past price and price on target date at 00:00:00
-            target_file = cast(
-                pd.DataFrame,
-                pd.read_csv(
-                    price_by_half_day_path.joinpath(f"{interval_mins}_{pair_name}.csv"),
-                    index_col="Open time",
-                    parse_dates=True,
-                ),
-            )
+            target_file = read_features(
+                price_by_half_day_path.joinpath(f"{interval_mins}_{pair_name}.csv"),
+                epoch_ms(date) - growth_period * interval_ms(interval_mins),
+                epoch_ms(date),
+                ["Close"],
+            ).set_index("Open time")
             # target_file = cast(pd.DataFrame, target_file)
-            target_last_index = target_file.index.get_loc(date)
+            target_last_index = target_file.index.get_loc(epoch_ms(date))
             # true price is the price on the target date at 00:00:00
             true_price_on_target_date_at_midnight = target_file.iloc[
                 target_last_index
@@ -1,4 +1,5 @@
 import logging
+import os
 from datetime import datetime, timedelta
 from pathlib import Path
 from dateutil.relativedelta import relativedelta
@@ -25,10 +26,53 @@ backtest_result_path = BUCKET_ROOT.joinpath("5_backtest_result")
 visualization_path = BUCKET_ROOT.joinpath("6_visualization_path")
 max_price_file = BUCKET_ROOT.joinpath("agg_max_price.csv")
 open_price_file = BUCKET_ROOT.joinpath("agg_open_price.csv")
+kline_cache_path = BUCKET_ROOT.joinpath("kline_cache")
+kline_archives_path = BUCKET_ROOT.joinpath("kline_archives")
+feature_fingerprints_path = BUCKET_ROOT.joinpath("feature_fingerprints")
+feature_index_path = BUCKET_ROOT.joinpath("feature_index")
+feature_cache_path = BUCKET_ROOT.joinpath("feature_cache")
+validation_report_file = BUCKET_ROOT.joinpath("validation_report.json")
 
 # Pool sizes
 price_by_minutes_pool_size = 5
 price_by_half_day_pool_size = 10
+## Memory the jobs of a pool may hold at once (see _scheduler.py), a job
+## estimated above it runs alone
+pool_memory_budget_mb = int(os.environ.get("POOL_MEMORY_BUDGET_MB", 4096))
+
+# Binance ingestion
+## Point BINANCE_API_URL to a local stand-in (see _binance_standin.py) to run offline
+binance_api_url = os.environ.get("BINANCE_API_URL", "https://api.binance.com")
+binance_kline_url = f"{binance_api_url}/api/v3/klines"
+## Combined kline websocket used by stream_price_by_minutes.py
+binance_stream_url = os.environ.get(
+    "BINANCE_STREAM_URL", "wss://stream.binance.com:9443"
+)
+## Closed bars received from the stream are written at most this often
+stream_flush_seconds = 10
+## Prometheus text endpoint of the ingestion scripts (see _metrics.py), 0 disables it
+metrics_host = os.environ.get("METRICS_HOST", "127.0.0.1")
+metrics_port = int(os.environ.get("METRICS_PORT", 9108))
+## Set to False to go back to the multiprocessing Pool with blocking requests
+price_by_minutes_async = True
+## Keep-alive connections shared by every pair in the async ingester
+binance_max_connections = 20
+## Pages requested ahead of the one being written, per pair
+price_by_minutes_pages_in_flight = 4
+## Request weight budget per minute (X-MBX-USED-WEIGHT-1M) and the share of it we use
+binance_weight_limit = 6000
+binance_weight_safety_margin = 0.8
+kline_request_weight = 2
+## Closed kline pages are cached on disk and never requested twice
+kline_cache_enabled = True
+kline_cache_max_bytes = 4 * 1024**3
+
+# Minute store (one directory per pair, one chunk per month)
+## Months older than the latest one are packed in a compressed .npz
+## set to False to keep every month memory-mappable
+minute_store_compress_sealed = True
+## Rows buffered by the ingester before a month chunk is rewritten
+minute_store_flush_rows = 50_000
 
 # Dates
 
@@ -46,11 +90,31 @@ end_date = datetime(year=2023, month=12, day=7, hour=0, minute=0, second=0).repl
 
 timeperiod_list = [10, 20, 30]
 interval_mins = "720min"
+## Also built by populate_price_by_half_day.py from the same pass over the
+## minutes, each into BUCKET_ROOT/1_by_<interval> (training only reads interval_mins)
+extra_interval_mins = ["60min", "240min", "1440min"]
+## Bars kept before the new ones when feature files are extended; the EMA based
+## indicators (T3, TRIX, HT_TRENDLINE...) need this much history to settle
+indicator_warmup_rows = 1000
+## dtype of the indicator columns written to the feature files and of the
+## training arrays ("float64" for the full precision path). Indicators are
+## still computed in float64, and the raw bar columns stay float64 so that
+## extending a file recomputes exactly what a full rebuild would
+feature_dtype = os.environ.get("FEATURE_DTYPE", "float32")
+## Parsed feature matrices kept as memory-mapped .npy for training (see
+## _feature_cache.py), on disk and mapped at once, least recently used dropped
+feature_cache_max_bytes = int(os.environ.get("FEATURE_CACHE_MB", 2048)) * 1024**2
+## validate_data.py warns about runs of unchanged, volume-less minutes (or
+## of bars filled from the previous close) lasting this long
+stale_run_minutes = 360
 
 num_layers = 2
 feedforward = 128
 dropout = 0.3
 epochs = 25
+## Epochs of fine-tuning when training starts from the previous date's model
+## (training_model.py --warm-start)
+warm_start_epochs = 5
 seed = 77
 
 # Features parameters (don't change this)
@@ -0,0 +1,135 @@
+"""Builds agg_open_price.csv and agg_max_price.csv from the local minute store.
+
+Both tables are computed in one pass over each pair's minute bars (daily
+open = open of the first minute of the day, daily max = highest high of the
+day). Prices are written as the exchange sends them, with 8 decimals.
+
+Re-running is idempotent: the files are rewritten, and only the days from the
+last one already in the tables onwards are recomputed, since that last day may
+have been partial. Minutes backfilled under days already in the tables are
+found through the gap index summaries recorded at the previous run, and the
+days from the earliest one touched are recomputed too.
+"""
+import json
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from _gap_index import GapIndex, subtract_ranges
+from _list_of_currency_pairs import currency_pairs
+from _store import minute_store
+from config import end_date, logging, max_price_file, open_price_file, start_date
+
+minute_ms = 60_000
+day_ms = 86_400_000
+# gap index month summaries of every pair, as of the last build of the tables
+sources_file = open_price_file.with_suffix(".sources.json")
+
+# the price text of every (pair, date), kept as read so rows not recomputed
+# are written back unchanged
+DailyTable = Dict[Tuple[str, str], str]
+
+
+def format_price(price: float) -> str:
+    return f"{price:.8f}"
+
+
+def read_daily_table(file: Path) -> DailyTable:
+    if not file.exists():
+        return {}
+    with open(file, "r") as f:
+        lines = f.read().split("\n")[:-1]
+    data = [i.split(",") for i in lines]
+    return {(i[2], i[3]): i[1] for i in data}
+
+
+def write_daily_table(file: Path, table: DailyTable):
+    pair_order = {pair: i for i, pair in enumerate(currency_pairs)}
+    keys = sorted(table, key=lambda k: (pair_order.get(k[0], len(pair_order)), k))
+    tmp = file.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        for iterator, (symbol, date) in enumerate(keys):
+            f.write(f"{iterator},{table[(symbol, date)]},{symbol},{date}\n")
+    tmp.replace(file)
+
+
+def daily_open_high(
+    currency_pair: str, start_ms: int, end_ms: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return (day start in ms, daily open, daily high) for the stored minutes"""
+    data = minute_store(currency_pair).read(
+        ["open_time", "open", "high"], start_ms, end_ms
+    )
+    times = data["open_time"]
+    if not len(times):
+        return times, data["open"], data["high"]
+    days, first = np.unique(times // day_ms, return_index=True)
+    return days * day_ms, data["open"][first], np.maximum.reduceat(data["high"], first)
+
+
+def earliest_change(before: Optional[dict], after: dict, interval_ms: int) -> Optional[int]:
+    """Earliest open time whose minutes changed between two summaries of a
+    month, None when the month holds the same minutes"""
+    if before is None:
+        return after["first"]
+    if after["first"] != before["first"]:
+        return min(after["first"], before["first"])
+    filled = subtract_ranges(
+        [tuple(i) for i in before["gaps"]], [tuple(i) for i in after["gaps"]]
+    )
+    if filled:
+        return filled[0][0]
+    if after["last"] != before["last"]:
+        return min(after["last"], before["last"]) + interval_ms
+    if after["rows"] != before["rows"] or after["gaps"] != before["gaps"]:
+        return after["first"]
+    return None
+
+
+def backfilled_since(months: Dict[str, dict], built: Dict[str, dict]) -> Optional[int]:
+    """Earliest open time of the minutes that changed since the last build"""
+    changes = [
+        earliest_change(built.get(month), summary, minute_ms)
+        for month, summary in months.items()
+    ]
+    changes = [i for i in changes if i is not None]
+    return min(changes) if changes else None
+
+
+def main():
+    open_prices = read_daily_table(open_price_file)
+    max_prices = read_daily_table(max_price_file)
+    built = json.loads(sources_file.read_text()) if sources_file.exists() else {}
+    start_ms = int(start_date.timestamp()) * 1000
+    end_ms = (int(end_date.timestamp()) * 1000 // day_ms + 1) * day_ms - 1
+    sources = {}
+    for symbol in currency_pairs:
+        store = minute_store(symbol)
+        months = GapIndex(store).refresh().months if store.root.exists() else {}
+        sources[symbol] = months
+        known = [d for s, d in open_prices if s == symbol]
+        known_max = [d for s, d in max_prices if s == symbol]
+        pair_start_ms = start_ms
+        if known and known_max and symbol in built:
+            last_day = min(max(known), max(known_max))
+            pair_start_ms = int(np.datetime64(last_day, "ms").astype(np.int64))
+            changed = backfilled_since(months, built[symbol])
+            if changed is not None:
+                pair_start_ms = min(pair_start_ms, changed // day_ms * day_ms)
+            pair_start_ms = max(start_ms, pair_start_ms)
+        days, opens, highs = daily_open_high(symbol, pair_start_ms, end_ms)
+        dates = days.astype("datetime64[ms]").astype("datetime64[D]").astype(str)
+        for date, open_, high in zip(dates.tolist(), opens.tolist(), highs.tolist()):
+            open_prices[(symbol, date)] = format_price(open_)
+            max_prices[(symbol, date)] = format_price(high)
+        logging.info(f"{symbol} | {len(dates)} days updated")
+    write_daily_table(open_price_file, open_prices)
+    write_daily_table(max_price_file, max_prices)
+    tmp = sources_file.with_suffix(".tmp")
+    tmp.write_text(json.dumps(sources))
+    tmp.replace(sources_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Imports Binance kline archives (data.binance.vision format) into the minute store.
+
+Put the monthly ``<PAIR>-1m-YYYY-MM.zip`` and/or daily
+``<PAIR>-1m-YYYY-MM-DD.zip`` files anywhere under kline_archives_path, then
+
+    python import_kline_archives.py
+
+Archives are parsed in parallel and written to each pair store in
+chronological order. Archives already imported (same name and size) are
+skipped, and every archive is checked against the expected minute grid.
+Minutes before start_date_4_populate are not imported.
+Run populate_price_by_minutes.py afterwards to fetch the last hours over REST.
+"""
+import calendar
+import io
+import json
+import re
+import zipfile
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from _gap_index import GapIndex
+from _list_of_currency_pairs import currency_pairs
+from _store import ChunkedStore, epoch_ms, minute_columns, minute_store
+from config import (
+    format_exc,
+    kline_archives_path,
+    logging,
+    price_by_minutes_pool_size,
+    start_date_4_populate as start_date,
+)
+
+archive_name = re.compile(r"^([A-Z0-9]+)-1m-(\d{4})-(\d{2})(?:-(\d{2}))?\.zip$")
+
+
+def find_archives(root: Path) -> List[Tuple[str, str, Path]]:
+    """Return (pair, period, path) sorted by pair then period"""
+    archives = []
+    for path in root.rglob("*.zip"):
+        match = archive_name.match(path.name)
+        if match is None or match.group(1) not in currency_pairs:
+            continue
+        pair, year, month, day = match.groups()
+        period = f"{year}-{month}" + (f"-{day}" if day else "")
+        archives.append((pair, period, path))
+    # a month sorts before its daily files, so the pair stores get written in order
+    return sorted(archives)
+
+
+def expected_minutes(period: str) -> int:
+    if len(period) == 10:
+        return 1440
+    year, month = map(int, period.split("-"))
+    return calendar.monthrange(year, month)[1] * 1440
+
+
+def read_archive(
+    archive: Tuple[str, str, Path]
+) -> Tuple[str, str, Path, Optional[Dict[str, np.ndarray]], dict]:
+    pair, period, path = archive
+    try:
+        with zipfile.ZipFile(path) as z:
+            raw = z.read(z.namelist()[0])
+        has_header = not raw[:1].isdigit()
+        frame = pd.read_csv(
+            io.BytesIO(raw),
+            header=0 if has_header else None,
+            names=list(minute_columns),
+            dtype=minute_columns,
+        )
+        columns = {c: frame[c].to_numpy() for c in minute_columns}
+        for c in ("open_time", "close_time"):
+            # spot archives switched to microseconds in 2025
+            if len(columns[c]) and columns[c][0] > 10**14:
+                columns[c] = columns[c] // 1000
+        times = columns["open_time"]
+        period_start = np.datetime64(period, "ms").astype(np.int64)
+        period_end = period_start + expected_minutes(period) * 60_000
+        report = {
+            "rows": int(len(times)),
+            "expected": expected_minutes(period),
+            "off_grid": int((times % 60_000 != 0).sum()),
+            "out_of_period": int(((times < period_start) | (times >= period_end)).sum()),
+            "duplicates": int(len(times) - len(np.unique(times))),
+            "size": path.stat().st_size,
+        }
+        # no stage reads minutes before start_date_4_populate, and a store
+        # starting earlier would be skipped by the feature build
+        keep = times >= epoch_ms(start_date)
+        report["before_start"] = int((~keep).sum())
+        if not keep.all():
+            columns = {c: v[keep] for c, v in columns.items()}
+        return pair, period, path, columns, report
+    except Exception:
+        logging.error(f"{path.name} | {format_exc()}")
+        return pair, period, path, None, {}
+
+
+def load_manifest(store: ChunkedStore) -> dict:
+    path = store.root.joinpath("archives.json")
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def save_manifest(store: ChunkedStore, manifest: dict):
+    store.root.mkdir(parents=True, exist_ok=True)
+    path = store.root.joinpath("archives.json")
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, indent=1))
+    tmp.replace(path)
+
+
+def main(root: Path = kline_archives_path):
+    archives = find_archives(root)
+    manifests = {
+        pair: load_manifest(minute_store(pair)) for pair in {a[0] for a in archives}
+    }
+    todo = [
+        a
+        for a in archives
+        if manifests[a[0]].get(a[2].name, {}).get("size") != a[2].stat().st_size
+    ]
+    logging.info(f"{len(archives)} archives found, {len(todo)} to import")
+    writers = {}
+    with Pool(price_by_minutes_pool_size) as p:
+        for pair, period, path, columns, report in p.imap(read_archive, todo):
+            if columns is None:
+                continue
+            if report["rows"] != report["expected"] or any(
+                report[k] for k in ("off_grid", "out_of_period", "duplicates")
+            ):
+                logging.warning(f"{path.name} | Does not match the minute grid: {report}")
+            if pair not in writers:
+                writers[pair] = minute_store(pair).writer()
+            writers[pair].write(columns)
+            manifests[pair][path.name] = report
+            logging.info(
+                f"{path.name} | {len(columns['open_time'])} rows imported"
+                + (f", {report['before_start']} before {start_date}" if report["before_start"] else "")
+            )
+    for pair, writer in writers.items():
+        writer.flush()
+        save_manifest(writer.store, manifests[pair])
+        index = GapIndex(writer.store).refresh()
+        logging.info(f"{pair} | {len(index.gaps())} gaps left after the import")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,44 @@
 # -*- coding: utf-8 -*-
 
+import argparse
+import io
+import json
 import logging
+import os
+from datetime import datetime
+from functools import partial
 from traceback import format_exc
-from typing import cast
-from multiprocessing import Pool
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
-import talib
 from pytz import UTC
 
+from _feature_files import index_feature_file, read_features, row_offset
+from _features import build_features, fingerprints
+from _features import registry as feature_registry
+from _gap_index import GapIndex
+from _resample import interval_ms, resample_store
+from _scheduler import Job, run_jobs
+from _store import ChunkedStore, epoch_ms, minute_columns, minute_store, month_keys
 from config import (
+    BUCKET_ROOT,
     end_date,
+    extra_interval_mins,
+    feature_dtype,
+    feature_fingerprints_path,
+    indicator_warmup_rows,
     interval_mins,
     logging,
     price_by_half_day_path,
     price_by_half_day_pool_size,
     price_by_minutes_path,
     start_date_4_populate as start_date,
-    timeperiod_list,
+    x_columns,
 )
 
 
-def load_and_process_csv(file_path: Path) -> pd.DataFrame:
-    logging.info("Loading data...")
-    data = cast(pd.DataFrame, pd.read_csv(file_path))
-    if "Unnamed: 0" in data.columns:
-        data = data.drop("Unnamed: 0", axis=1)
-    data = data[data["Ignore"] == 0]  # type: ignore
-    data = data.drop(columns=["Ignore", "Close time"])  # type: ignore
-    #  This format assumes that the date format in the CSV files will always match this pattern.
-    #  If there's any variation in the date format in the CSV files, this could lead to parsing errors.
-    data["Open time"] = pd.to_datetime(  # type: ignore
-        data["Open time"], format="%Y/%m/%d %H:%M"  # type: ignore
-    ).dt.strftime(
-        "%Y-%m-%d %H:%M:%S"
-    )  # type: ignore
-    return cast(pd.DataFrame, data)
-
-
 def fill_missing_values(data: pd.DataFrame):
     data["Volume"] = data["Volume"].fillna(0)  # type: ignore
     data["Quote asset volume"] = data["Quote asset volume"].fillna(0)  # type: ignore
@@ -55,132 +55,335 @@ def fill_missing_values(data: pd.DataFrame):
     return data
 
 
-def calculate_indicators(data: pd.DataFrame):
-    """Feat"""
-    # Note: open and volume are not used
-    # keeping them for legacy code tracking
-    # open = data["Open"]
-    close = data["Close"]
-    high = data["High"]
-    low = data["Low"]
-    # volume = data["Volume"]
-
-    data["CPG24"] = (close - close.shift(24)) / (close.shift(24))  # type: ignore
-    data["CPG48"] = (close - close.shift(48)) / (close.shift(48))  # type: ignore
-    data["CPG72"] = (close - close.shift(72)) / (close.shift(72))  # type: ignore
-    data["CPG96"] = (close - close.shift(96)) / (close.shift(96))  # type: ignore
-    data["CPG1"] = (close - close.shift(1)) / (close.shift(1))  # type: ignore
-    data["APO"] = talib.APO(close)  # type: ignore
-    data["CCI_30"] = talib.CCI(high, low, close, timeperiod=30)  # type: ignore
-
-    for tp in timeperiod_list:
-        data[f"CMO_{tp}"] = talib.CMO(close, timeperiod=tp)  # type: ignore
-    for tp in timeperiod_list:
-        data[f"DEMA_{tp}"] = talib.DEMA(close, timeperiod=tp)  # type: ignore
-    for tp in timeperiod_list:
-        data[f"EMA_{tp}"] = talib.EMA(close, timeperiod=tp)  # type: ignore
-
-    data["HT_TRENDLINE"] = talib.HT_TRENDLINE(close)  # type: ignore
-
-    data["MACD"], data["MACDSIGNAL"], data["MACDHIST"] = talib.MACD(close)  # type: ignore
-    data["MACDEXT"], data["MACDEXTSIGNAL"], data["MACDEXTHIST"] = talib.MACDEXT(close)  # type: ignore
-    data["MACDFIX"], _, data["MACDFIXHIST"] = talib.MACDFIX(close)  # type: ignore
-
-    data["MIDPOINT_20"] = talib.MIDPOINT(close, timeperiod=20)  # type: ignore
-    data["MIDPRICE_20"] = talib.MIDPRICE(high, low, timeperiod=20)  # type: ignore
-    data["MINUS_DI_20"] = talib.MINUS_DI(high, low, close, timeperiod=20)  # type: ignore
-
-    for tp in timeperiod_list:
-        data[f"MOM_{tp}"] = talib.MOM(close, timeperiod=tp)  # type: ignore
-
-    data["PLUS_DI_10"] = talib.PLUS_DI(high, low, close, timeperiod=10)  # type: ignore
-    data["PLUS_DI_30"] = talib.PLUS_DI(high, low, close, timeperiod=30)  # type: ignore
-    data["PPO"] = talib.PPO(close)  # type: ignore
-
-    for tp in timeperiod_list:
-        data[f"ROCP_{tp}"] = talib.ROCP(close, timeperiod=tp)  # type: ignore
-    for tp in timeperiod_list:
-        data[f"ROCR_{tp}"] = talib.ROCR(close, timeperiod=tp)  # type: ignore
-    for tp in timeperiod_list:
-        data[f"ROCR100_{tp}"] = talib.ROCR100(close, timeperiod=tp)  # type: ignore
-    for tp in timeperiod_list:
-        data[f"ROC_{tp}"] = talib.ROC(close, timeperiod=tp)  # type: ignore
-    for tp in timeperiod_list:
-        data[f"RSI_{tp}"] = talib.RSI(close, timeperiod=tp)  # type: ignore
-
-    data["T3_20"] = talib.T3(close, timeperiod=20)  # type: ignore
-
-    for tp in timeperiod_list:
-        data[f"TRIMA_{tp}"] = talib.TRIMA(close, timeperiod=tp)  # type: ignore
-
-    data["TRIX_10"] = talib.TRIX(close, timeperiod=10)  # type: ignore
-    data["TRIX_20"] = talib.TRIX(close, timeperiod=20)  # type: ignore
-
-    for tp in timeperiod_list:
-        data[f"WMA_{tp}"] = talib.WMA(close, timeperiod=tp)  # type: ignore
-
-    data["ULTOSC_20"] = talib.ULTOSC(  # type: ignore
-        high, low, close, timeperiod1=20, timeperiod2=20 * 2, timeperiod3=20 * 4
+def calculate_indicators(data: pd.DataFrame, dtype: str = feature_dtype):
+    """Feat, only the columns the model reads (see _features.py)"""
+    return build_features(data, x_columns, dtype)
+
+
+def interval_output_path(interval: str) -> Path:
+    """The training interval keeps the half-day folder, others get their own"""
+    if interval == interval_mins:
+        return price_by_half_day_path
+    return BUCKET_ROOT.joinpath(f"1_by_{interval}")
+
+
+def read_csv_tail(file: Path, rows: int) -> Tuple[pd.DataFrame, List[int]]:
+    """Last ``rows`` rows of a csv, with the byte offset each of them starts at"""
+    with open(file, "rb") as f:
+        header = f.readline()
+        data_start = f.tell()
+        end = f.seek(0, os.SEEK_END)
+        position, buffer = end, b""
+        while position > data_start and buffer.count(b"\n") <= rows:
+            step = min(1 << 16, position - data_start)
+            position -= step
+            f.seek(position)
+            buffer = f.read(step) + buffer
+    lines = buffer.splitlines(keepends=True)
+    if position > data_start:
+        # the first line may start before the bytes we read
+        position += len(lines.pop(0))
+    position += sum(len(i) for i in lines[:-rows])
+    lines = lines[-rows:]
+    offsets = [int(i) for i in position + np.cumsum([0] + [len(i) for i in lines[:-1]])]
+    # parsed exactly, values carried into the rows written back must not move
+    frame = pd.read_csv(io.BytesIO(header + b"".join(lines)), float_precision="round_trip")
+    return frame, offsets
+
+
+def build_feature_frame(bars: pd.DataFrame, dtype: str = feature_dtype) -> pd.DataFrame:
+    return calculate_indicators(fill_missing_values(bars), dtype)
+
+
+intervals = list(dict.fromkeys([interval_mins] + extra_interval_mins))
+
+
+def fingerprints_file(feature_file: Path) -> Path:
+    return feature_fingerprints_path.joinpath(f"{feature_file.stem}.json")
+
+
+def save_fingerprints(feature_file: Path):
+    feature_fingerprints_path.mkdir(parents=True, exist_ok=True)
+    fingerprints_file(feature_file).write_text(json.dumps(fingerprints(x_columns), indent=1))
+
+
+def refresh_columns(feature_file: Path):
+    """Recompute the columns whose code or parameters changed, keep the others.
+
+    Rows are left as they are: the raw bars come from the file itself, so the
+    minute store is not read again.
+    """
+    stored_file = fingerprints_file(feature_file)
+    stored = json.loads(stored_file.read_text()) if stored_file.exists() else {}
+    wanted = fingerprints(x_columns)
+    with open(feature_file) as f:
+        columns = f.readline().rstrip("\n").split(",")
+    # the file holds the features in registry order, not in x_columns order
+    if stored == wanted and set(wanted) <= set(columns):
+        return
+    # parsed exactly, the columns kept are written back as they were
+    data = pd.read_csv(feature_file, float_precision="round_trip")
+    stale = [c for c in data.columns if c in feature_registry and stored.get(c) != wanted.get(c)]
+    added = [c for c in wanted if c not in data.columns]
+    logging.info(
+        f"{feature_file.name} | Computing {len(added)} new and {len(stale)} changed feature columns"
     )
-    data["ULTOSC_30"] = talib.ULTOSC(  # type: ignore
-        high, low, close, timeperiod1=30, timeperiod2=30 * 2, timeperiod3=30 * 4
+    data = calculate_indicators(data.drop(columns=stale))
+    tmp = feature_file.with_suffix(".tmp")
+    data.to_csv(tmp, index=False)
+    tmp.replace(feature_file)
+    save_fingerprints(feature_file)
+    index_feature_file(feature_file)
+
+
+def sources_file(feature_file: Path) -> Path:
+    return feature_fingerprints_path.joinpath(f"{feature_file.stem}.sources.json")
+
+
+def store_months(store: ChunkedStore) -> Dict[str, list]:
+    """First and last open time and row count of every month of the store"""
+    return {
+        month: [summary["first"], summary["last"], summary["rows"]]
+        for month, summary in GapIndex(store).refresh().months.items()
+    }
+
+
+def rows_before(store: ChunkedStore, month: str, time_ms: int) -> int:
+    times = store.read_month(month, [store.time_column])[store.time_column]
+    return int(np.searchsorted(times, time_ms))
+
+
+def save_sources(feature_file: Path, store: ChunkedStore, months: Dict[str, list]):
+    """Record the minutes the rows of a feature file were built from.
+
+    Months before the one of the last row are kept whole; for that month
+    only the minutes before the last row count, as the next run rebuilds
+    that row anyway and later minutes are simply new.
+    """
+    with open(feature_file, "rb") as f:
+        f.seek(-min(1 << 16, f.seek(0, os.SEEK_END)), os.SEEK_END)
+        last = f.read().splitlines()[-1]
+    until = int(last[: last.index(b",")])
+    month = str(month_keys(np.array([until]))[0])
+    feature_fingerprints_path.mkdir(parents=True, exist_ok=True)
+    sources_file(feature_file).write_text(
+        json.dumps(
+            {
+                "until": until,
+                "months": {m: v for m, v in months.items() if m < month},
+                "rows_before_until": rows_before(store, month, until) if month in months else 0,
+            }
+        )
     )
 
-    _, data["middleband_SMA_10"], _ = talib.BBANDS(  # type: ignore
-        close, timeperiod=10, nbdevup=2, nbdevdn=2, matype=0
-    )
-    _, data["middleband_SMA_20"], _ = talib.BBANDS(  # type: ignore
-        close, timeperiod=20, nbdevup=2, nbdevdn=2, matype=0
-    )
-    data["lowerband_SMA_30"], _, _ = talib.BBANDS(  # type: ignore
-        close, timeperiod=30, nbdevup=2, nbdevdn=2, matype=0
+
+def changed_since(
+    feature_file: Path, store: ChunkedStore, months: Dict[str, list]
+) -> Optional[str]:
+    """Earliest month whose minutes changed under rows already in the file
+    (a gap backfill, an archive import), None when only new minutes came"""
+    if not sources_file(feature_file).exists():
+        return None
+    sources = json.loads(sources_file(feature_file).read_text())
+    month = str(month_keys(np.array([sources["until"]]))[0])
+    earlier = set(sources["months"]) | {m for m in months if m < month}
+    changed = sorted(m for m in earlier if months.get(m) != sources["months"].get(m))
+    if changed:
+        return changed[0]
+    if month in months and rows_before(store, month, sources["until"]) != sources[
+        "rows_before_until"
+    ]:
+        return month
+    return None
+
+
+def compare_features(label: str, rows: pd.DataFrame, expected: pd.DataFrame) -> bool:
+    """Feature rows against the same bars computed another way.
+
+    Values may differ by rounding: within 1e-9 relative, or 1e-9 of the
+    largest value of the column where they cross zero. Columns stored in
+    a smaller float type get a few of its epsilons instead, as the two
+    sides may round to neighbouring values.
+    """
+    expected = expected[expected["Open time"].isin(rows["Open time"])].reset_index(drop=True)
+    rows = rows.reset_index(drop=True)
+    if len(expected) != len(rows):
+        logging.error(f"{label} | {len(rows)} rows, {len(expected)} expected")
+        return False
+    mismatched = []
+    for c in rows.columns.drop("Open time"):
+        a, b = rows[c].to_numpy(np.float64), expected[c].to_numpy(np.float64)
+        scale = np.nanmax(np.abs(b), initial=0)
+        rtol = max(1e-9, 4 * float(np.finfo(rows[c].dtype).eps))
+        if not np.allclose(a, b, rtol=rtol, atol=1e-12 + rtol * scale, equal_nan=True):
+            mismatched.append(f"{c} ({np.nanmax(np.abs(a - b)):.3g})")
+    if mismatched:
+        logging.error(f"{label} | Differs: {', '.join(mismatched)}")
+        return False
+    logging.info(f"{label} | {len(rows)} rows match")
+    return True
+
+
+def verify_features(
+    store: ChunkedStore, interval: str, rows: pd.DataFrame, start_ms: int, end_ms: int
+) -> bool:
+    """Compare incrementally computed rows with a full recompute"""
+    full = build_feature_frame(
+        resample_store(store, [interval], start_ms, end_ms, origin_ms=start_ms)[interval]
     )
+    return compare_features(f"{interval}_{store.name} full recompute", rows, full)
+
+
+def usable_store(store_dir: Path) -> Optional[ChunkedStore]:
+    """Minute store of a pair, None when it has no minutes between the dates.
+
+    Minutes outside start_date .. end_date (an archive month starting
+    earlier, bars the stream daemon appended past end_date) are left out by
+    the range reads below, they do not disqualify the store.
+    """
+    store = minute_store(store_dir.name, store_dir.parent)
+    logging.debug(f"Processing: {store.root}")
+    first_time, last_time = store.first_time(), store.last_time()
+    if first_time is None or last_time is None:
+        logging.info(f"empty store, skipping: {store.root}...")
+        return None
+    file_start_date = datetime.fromtimestamp(first_time / 1000, tz=UTC)
+    file_end_date = datetime.fromtimestamp(last_time / 1000, tz=UTC)
+    logging.debug(f"start_date: {file_start_date}")
+    logging.debug(f"end_date: {file_end_date}")
+    if file_end_date < start_date or file_start_date > end_date:
+        logging.debug(
+            f"Conditions not met for {file_end_date} >= {start_date} "
+            f"and {file_start_date} <= {end_date}"
+        )
+        logging.info(f"date out of range, skipping store: {store.root}...")
+        return None
+    return store
 
-    return data
+
+def feature_file(interval: str, pair: str) -> Path:
+    output_path = interval_output_path(interval)
+    output_path.mkdir(parents=True, exist_ok=True)
+    return output_path.joinpath(f"{interval}_{pair}.csv")
 
 
-def populate_by_currency_pair(raw_file: Path):
+def populate_by_currency_pair(store_dir: Path, full: bool = False, verify: bool = False):
+    """Write the feature files of a pair.
+
+    Unless ``full`` is set, existing files are extended: their last row (a
+    bar that may have been partial) is replaced and the new bars are computed
+    on top of the last indicator_warmup_rows bars of the file, which is
+    enough for every indicator to carry the same value as a full recompute.
+    """
     try:
-        logging.debug(f"Processing: {raw_file}")
-        data = load_and_process_csv(raw_file)
-
-        # Convert all dates in the df in dt format
-        data["Open time"] = pd.to_datetime(data["Open time"], format="%Y/%m/%d %H:%M")  # type: ignore
-        # data["Open time"] = data["Open time"].dt.tz_localize(None)
-
-        logging.debug(data.iloc[0]["Open time"])
-        file_start_date = data.iloc[0]["Open time"].replace(tzinfo=UTC)
-        file_end_date = data.iloc[-1]["Open time"].replace(tzinfo=UTC)
-        logging.debug(f"start_date: {file_start_date}")
-        logging.debug(f"end_date: {file_end_date}")
-        if file_start_date < start_date or file_end_date > end_date:
-            logging.debug(
-                f"Conditions not met for {file_start_date} > {start_date} "
-                f"or {file_end_date} < {end_date}"
-            )
-            logging.info(f"date out of range, skipping file: {raw_file}...")
+        store = usable_store(store_dir)
+        if store is None:
             return
-        # Create the full time given the start date and end date
-        timestamp = pd.date_range(
-            start=start_date, end=end_date, freq=interval_mins, tz="UTC"
+        start_ms = int(start_date.timestamp()) * 1000
+        end_ms = int(end_date.timestamp()) * 1000
+
+        months = store_months(store)
+        files, tails, since = {}, {}, {}
+        for interval in intervals:
+            files[interval] = feature_file(interval, store.name)
+            since[interval] = start_ms
+            if not full and files[interval].exists():
+                refresh_columns(files[interval])
+                tail, offsets = read_csv_tail(files[interval], indicator_warmup_rows + 1)
+                if len(tail) and not pd.api.types.is_integer_dtype(tail["Open time"]):
+                    # written before open times were kept in epoch ms
+                    logging.warning(f"{files[interval].name} | Date strings, rebuilding")
+                elif len(tail):
+                    changed = changed_since(files[interval], store, months)
+                    if changed is None:
+                        tails[interval] = (tail.iloc[:-1], offsets[-1])
+                        since[interval] = int(tail["Open time"].iloc[-1])
+                    elif epoch_ms(f"{changed}-01") > start_ms:
+                        # the first bar holding a minute of the changed month
+                        step = interval_ms(interval)
+                        first = start_ms + (epoch_ms(f"{changed}-01") - start_ms) // step * step
+                        logging.info(
+                            f"{files[interval].name} | Minutes of {changed} changed, "
+                            "rebuilding from there"
+                        )
+                        warmup = read_features(
+                            files[interval],
+                            first - indicator_warmup_rows * step,
+                            first - 1,
+                            float_precision="round_trip",
+                        )
+                        tails[interval] = (warmup, row_offset(files[interval], first))
+                        since[interval] = first
+                    else:
+                        logging.info(
+                            f"{files[interval].name} | Minutes of {changed} changed, rebuilding"
+                        )
+        logging.info("Resampling data...")
+        frames = resample_store(
+            store, intervals, min(since.values()), end_ms, origin_ms=start_ms
         )
-        logging.info(f"Timeframe: {timestamp}")
-
-        new_data = pd.DataFrame({"Open time": timestamp})
-        new_data["Open time"] = new_data["Open time"].dt.tz_localize(None)  # type: ignore
-        new_data = new_data.merge(data, on="Open time", how="left")
-        new_data = fill_missing_values(new_data)
-        new_data = calculate_indicators(new_data)
-
-        save_file_path = price_by_half_day_path.joinpath(f"{interval_mins}_{raw_file.name}")
-        logging.debug(f"Saving results to: {save_file_path}")
-        new_data.to_csv(save_file_path, index=False)
-        logging.info(f"Finished file: {raw_file}")
+
+        for interval, bars in frames.items():
+            save_file_path = files[interval]
+            bars = bars[bars["Open time"] >= since[interval]]
+            if interval not in tails:
+                new_data = build_feature_frame(bars)
+                logging.debug(f"Saving results to: {save_file_path}")
+                new_data.to_csv(save_file_path, index=False)
+                save_fingerprints(save_file_path)
+                index_feature_file(save_file_path)
+                save_sources(save_file_path, store, months)
+                continue
+            tail, last_row_offset = tails[interval]
+            warmup = tail[list(bars.columns)]
+            new_data = build_feature_frame(pd.concat([warmup, bars], ignore_index=True))
+            new_data = new_data[new_data["Open time"] >= since[interval]]
+            if list(new_data.columns) != list(tail.columns):
+                logging.warning(f"{save_file_path.name} | Columns changed, rebuilding")
+                return populate_by_currency_pair(store_dir, full=True, verify=verify)
+            if verify:
+                verify_features(store, interval, new_data, start_ms, end_ms)
+            logging.debug(f"Appending {len(new_data)} rows to: {save_file_path}")
+            with open(save_file_path, "r+") as f:
+                f.truncate(last_row_offset)
+                f.seek(last_row_offset)
+                new_data.to_csv(f, index=False, header=False)
+            index_feature_file(save_file_path, last_row_offset)
+            save_sources(save_file_path, store, months)
+        logging.info(f"Finished store: {store.root}")
     except:
-        logging.error(f"Error {raw_file}")
+        logging.error(f"Error {store_dir}")
         logging.error(format_exc())
 
 
+def pair_job(store_dir: Path) -> Job:
+    """Scheduler job of a pair, its cost is the size of the pair's minutes.
+
+    Memory is a month of minutes, read one at a time, plus the bars and
+    features of every interval three times over for the copies made while
+    they are built and written.
+    """
+    row_bytes = sum(np.dtype(t).itemsize for t in minute_columns.values())
+    nbytes = minute_store(store_dir.name, store_dir.parent).nbytes()
+    bars = sum(nbytes // row_bytes // (interval_ms(i) // 60_000) for i in intervals)
+    memory = 31 * 1440 * row_bytes + bars * (len(x_columns) + 1) * 8 * 3
+    return Job(store_dir.name, store_dir, nbytes, memory)
+
+
 if __name__ == "__main__":
-    with Pool(price_by_half_day_pool_size) as p:
-        p.map(populate_by_currency_pair, price_by_minutes_path.iterdir())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--full", action="store_true", help="rebuild the feature files from scratch"
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check the appended rows against a full recompute",
+    )
+    args = parser.parse_args()
+    store_dirs = [i for i in price_by_minutes_path.iterdir() if i.is_dir()]
+    run_jobs(
+        partial(populate_by_currency_pair, full=args.full, verify=args.verify),
+        [pair_job(i) for i in store_dirs],
+        price_by_half_day_pool_size,
+    )
@@ -1,58 +1,50 @@
-import csv
-import os
+import argparse
+import asyncio
+from collections import deque
 from datetime import datetime, timedelta
-from multiprocessing import Pool
-from typing import Generator
+from pathlib import Path
+from typing import Deque, Dict, Generator, List, Tuple
 from time import sleep
 
+import numpy as np
+import pandas as pd
 import requests
-from pydantic import BaseModel
 from pytz import UTC
 
+from _binance import (
+    AsyncBinanceKLine,
+    decode_kline_page,
+    kline_intervals,
+    kline_page_size,
+    page_grid_start,
+    truncate_page,
+)
+from _gap_index import GapIndex, intersect_ranges
+from _kline_cache import KLinePageCache
 from _list_of_currency_pairs import currency_pairs
+from _metrics import start_metrics_server
+from _scheduler import Job, run_jobs
+from _store import (
+    ChunkedStore,
+    StoreWriter,
+    minute_columns,
+    minute_frame_names,
+    minute_store,
+)
 from config import (
+    binance_kline_url,
     end_date,
     format_exc,
+    kline_cache_enabled,
     logging,
+    minute_store_flush_rows,
+    price_by_minutes_async,
+    price_by_minutes_pages_in_flight,
     price_by_minutes_path,
     price_by_minutes_pool_size,
     start_date_4_populate as start_date,
 )
 
-binance_kline_url = "https://api.binance.com/api/v3/klines"
-
-
-class KLine(BaseModel):
-    open_time: int
-    open_price: str
-    high_price: str
-    low_price: str
-    close_price: str
-    volume: str
-    close_time: int
-    quote_volume: str
-    trades: int
-    taker_base_volume: str
-    taker_quote_volume: str
-    unused: str
-
-    @classmethod
-    def from_raw_data(cls, data):
-        return KLine(
-            open_time=data[0],
-            open_price=data[1],
-            high_price=data[2],
-            low_price=data[3],
-            close_price=data[4],
-            volume=data[5],
-            close_time=data[6],
-            quote_volume=data[7],
-            trades=data[8],
-            taker_base_volume=data[9],
-            taker_quote_volume=data[10],
-            unused=data[11],
-        )
-
 
 class BinanceKLine:
     _binance_max_page_size = 1000
@@ -75,11 +67,17 @@ class BinanceKLine:
             (self.end_date - self.start_date).total_seconds()
             / self.interval.total_seconds()
         )
+        self.cache = KLinePageCache() if kline_cache_enabled else None
 
-    def generate_klines(self) -> Generator[KLine, None, None]:
-        last_date = self.start_date_as_timestamp + self.interval_as_seconds
+    def generate_pages(self) -> Generator[Dict[str, np.ndarray], None, None]:
+        """Yield each page as column arrays, starting at start_date included"""
+        start_time_ms = self.start_date_as_timestamp * 1000
+        last_date = (
+            page_grid_start(start_time_ms, self.interval_as_seconds) // 1000
+        )
+        end_time_ms = self.end_date_as_timestamp * 1000
         i = 0
-        while True:
+        while last_date <= self.end_date_as_timestamp:
             if i % 10 == 0:
                 logging.info(f"{self.symbol} - Page {i}")
             binance_data = self._get_binance_page(
@@ -88,12 +86,11 @@ class BinanceKLine:
                 self.interval_as_seconds,
             )
             i += 1
-            for kline in binance_data:
-                k = KLine.from_raw_data(kline)
-                last_date = int(k.open_time / 1000)
-                if last_date > self.end_date_as_timestamp:
-                    return
-                yield k
+            page = decode_kline_page(binance_data)
+            if not len(page["open_time"]):
+                return
+            last_date = int(page["open_time"][-1] // 1000) + self.interval_as_seconds
+            yield truncate_page(page, end_time_ms, start_time_ms)
 
     def _get_binance_page(
         self,
@@ -101,30 +98,18 @@ class BinanceKLine:
         start_timestamp: int,
         interval_as_seconds: int,
     ):
-        intervals = {
-            1: "1s",
-            60: "1m",
-            120: "3m",
-            300: "5m",
-            900: "15m",
-            1800: "30m",
-            3600: "1h",
-            7200: "2h",
-            14400: "4h",
-            21600: "6h",
-            28800: "8h",
-            43200: "12h",
-            86400: "1d",
-            259200: "3d",
-            604800: "1w",
-            2592000: "1M",
-        }
         params = {
             "symbol": symbol,
             "startTime": start_timestamp * 1000,
-            "interval": intervals[interval_as_seconds],
+            "interval": kline_intervals[interval_as_seconds],
             "limit": self._binance_max_page_size,
         }
+        if self.cache is not None:
+            data = self.cache.get(
+                symbol, params["interval"], params["startTime"], params["limit"]
+            )
+            if data is not None:
+                return data
         for sleep_time in (1, 2, 3, 5, 8, 13, 21, 34, 55, 89):
             try:
                 response = requests.get(binance_kline_url, params=params)
@@ -139,100 +124,230 @@ class BinanceKLine:
             )
             raise Exception(response.text)
         data = response.json()
+        if self.cache is not None:
+            self.cache.put(
+                symbol,
+                params["interval"],
+                params["startTime"],
+                params["limit"],
+                response.content,
+                data,
+            )
         return data
 
 
-def xreadlines_reverse(f, blksz=524288):
-    f.seek(0, os.SEEK_END)
-    size = f.tell()
-    line = ""
-    for i in range(size // blksz, -1, -1):
-        f.seek(blksz * i)
-        block = f.read(blksz)
-        lines = block.split("\n")
-        if len(lines) > 1:
-            for i in lines[1:][::-1]:
-                if i:
-                    yield i + line
-                    line = ""
-        line = lines[0] + line
+def import_minutes_csv(file: Path, store: ChunkedStore):
+    """One-off conversion of a legacy append-only csv into the minute store"""
+    logging.info(f"{store.name} | Importing legacy file {file.name}...")
+    with store.writer() as writer:
+        for chunk in pd.read_csv(file, chunksize=minute_store_flush_rows):
+            columns = {}
+            for name, frame_name in minute_frame_names.items():
+                values = chunk[frame_name]
+                if name in ("open_time", "close_time"):
+                    values = pd.to_datetime(values, format="%Y-%m-%d %H:%M:%S")
+                    values = values.values.astype("datetime64[ms]").astype(np.int64)
+                    if name == "close_time":
+                        # the csv kept whole seconds only
+                        values = values + 999
+                columns[name] = np.asarray(values, dtype=minute_columns[name])
+            writer.write(columns)
+
+
+def open_minute_store(currency_pair: str) -> Tuple[ChunkedStore, datetime]:
+    """Return the pair store and the open time to resume writing from"""
+    store = minute_store(currency_pair)
+    logging.info(f"{currency_pair} | Let's start processing the {store.root} store...")
+    legacy_file = price_by_minutes_path.joinpath(f"{currency_pair}.csv")
+    if legacy_file.exists() and not store.exists():
+        import_minutes_csv(legacy_file, store)
+    last_time = store.last_time()
+    if last_time is None:
+        return store, start_date
+    open_time = datetime.fromtimestamp(last_time / 1000, tz=UTC)
+    return store, open_time + timedelta(minutes=1)
 
 
 def populate_for_pair(currency_pair: str):
     try:
-        file = price_by_minutes_path.joinpath(f"{currency_pair}.csv")
-        logging.info(
-            f"{currency_pair} | Let's start processing the {file.name} file..."
+        store, open_time = open_minute_store(currency_pair)
+        logging.debug(
+            f"{currency_pair} | The latest data in this store is for {open_time}"
         )
-        if not file.exists():
-            with open(file, "w") as f:
-                writer = csv.writer(f)
-                writer.writerow(
-                    [
-                        "",
-                        "Open time",
-                        "Open",
-                        "High",
-                        "Low",
-                        "Close",
-                        "Volume",
-                        "Close time",
-                        "Quote asset volume",
-                        "Number of trades",
-                        "Taker buy base asset volume",
-                        "Taker buy quote asset volume",
-                        "Ignore",
-                    ]
-                )
-            last_line_num = 0
-            open_time = start_date
-        else:
-            with open(file, "r") as f:
-                last_line = next(xreadlines_reverse(f, blksz=4096), None)
-            if last_line is not None:
-                last_line_num, open_time, *_ = last_line.split(",")
-                open_time = datetime.strptime(open_time, "%Y-%m-%d %H:%M:%S").replace(
-                    tzinfo=UTC
-                )
-                open_time += timedelta(minutes=1)
-            else:
-                last_line_num = 0
-                open_time = start_date
+        generator = BinanceKLine(currency_pair, open_time, end_date).generate_pages()
+        with store.writer() as writer:
+            logging.debug(f"{currency_pair} | Write to the end of the store...")
+            for page in generator:
+                writer.write(page)
+        GapIndex(store).refresh()
+        logging.info(f"{currency_pair} | Complete processing store {store.name}")
+    except:
+        print(format_exc())
+
+
+def minute_job(currency_pair: str) -> Job:
+    """Cost is the minutes left to fetch, memory the writer buffer and a
+    month rewrite"""
+    last_time = minute_store(currency_pair).last_time()
+    if last_time is None:
+        first_ms = int(start_date.timestamp()) * 1000
+    else:
+        first_ms = last_time + 60_000
+    rows = max(0, (int(end_date.timestamp()) * 1000 - first_ms) // 60_000 + 1)
+    row_bytes = sum(np.dtype(t).itemsize for t in minute_columns.values())
+    memory = (min(rows, minute_store_flush_rows) + 31 * 1440) * row_bytes
+    return Job(currency_pair, currency_pair, rows, memory)
+
+
+async def ingest_range(
+    currency_pair: str,
+    client: AsyncBinanceKLine,
+    writer: StoreWriter,
+    start_time_ms: int,
+    end_time_ms: int,
+    pages_in_flight: int = price_by_minutes_pages_in_flight,
+):
+    """Fetch [start_time_ms, end_time_ms] with several pages in flight.
+
+    Binance answers a page request with the first rows opened at or after its
+    start, so the first page shows where the pair's history begins (a pair
+    listed later has none before). From there page starts are known in
+    advance (one page is 1000 minutes) and the next pages are requested while
+    the current one is written, in order. A page reaching past the next
+    requested start (it skipped a gap) drops the pages in flight and the
+    requests go on after its last row; an empty page means there is nothing
+    more to fetch (delisted, or the latest bars).
+    """
+    page_span_ms = kline_page_size * 60 * 1000
+    in_flight: Deque[Tuple[int, asyncio.Task]] = deque()
+    next_start = page_grid_start(start_time_ms)
+    written_until = start_time_ms - 60_000
+
+    def cancel_in_flight():
+        while in_flight:
+            in_flight.popleft()[1].cancel()
+
+    page = decode_kline_page(await client.get_page(currency_pair, next_start))
+    next_start += page_span_ms
+    i = 0
+    try:
+        while len(page["open_time"]):
+            if i % 10 == 0:
+                logging.info(f"{currency_pair} - Page {i}")
+            i += 1
+            last_open = int(page["open_time"][-1])
+            first_ms = max(start_time_ms, written_until + 60_000)
+            writer.write(truncate_page(page, end_time_ms, first_ms))
+            written_until = max(written_until, last_open)
+            if last_open + 60_000 > (in_flight[0][0] if in_flight else next_start):
+                cancel_in_flight()
+                next_start = last_open + 60_000
+            while len(in_flight) < pages_in_flight and next_start <= end_time_ms:
+                task = asyncio.ensure_future(client.get_page(currency_pair, next_start))
+                in_flight.append((next_start, task))
+                next_start += page_span_ms
+            if not in_flight:
+                break
+            page = decode_kline_page(await in_flight.popleft()[1])
+    finally:
+        cancel_in_flight()
 
+
+async def populate_for_pair_async(currency_pair: str, client: AsyncBinanceKLine):
+    """Same output as populate_for_pair, over the shared async client"""
+    try:
+        store, open_time = open_minute_store(currency_pair)
         logging.debug(
-            f"{currency_pair} | The latest data in this file is for {open_time}"
+            f"{currency_pair} | The latest data in this store is for {open_time}"
         )
-        generator = BinanceKLine(currency_pair, open_time, end_date).generate_klines()
-        line_num = int(last_line_num)
-        with open(file, "a") as f:
-            writer = csv.writer(f)
-            logging.debug(f"{currency_pair} | Write to the end file...")
-            for kline in generator:
-                open_time = datetime.utcfromtimestamp(kline.open_time / 1000)
-                close_time = datetime.utcfromtimestamp(kline.close_time / 1000)
-                line_num += 1
-                writer.writerow(
-                    [
-                        line_num,
-                        open_time.strftime("%Y-%m-%d %H:%M:%S"),
-                        kline.open_price,
-                        kline.high_price,
-                        kline.low_price,
-                        kline.close_price,
-                        kline.volume,
-                        close_time.strftime("%Y-%m-%d %H:%M:%S"),
-                        kline.quote_volume,
-                        kline.trades,
-                        kline.taker_base_volume,
-                        kline.taker_quote_volume,
-                        kline.unused,
-                    ]
+        with store.writer() as writer:
+            await ingest_range(
+                currency_pair,
+                client,
+                writer,
+                int(open_time.timestamp()) * 1000,
+                int(end_date.timestamp()) * 1000,
+            )
+        GapIndex(store).refresh()
+        logging.info(f"{currency_pair} | Complete processing store {store.name}")
+    except:
+        logging.error(format_exc())
+
+
+async def backfill_pair(currency_pair: str, client: AsyncBinanceKLine):
+    """Fetch only the ranges the gap index reports as missing, concurrently.
+
+    Ranges that are still empty after a successful fetch do not exist on the
+    exchange and are marked as checked in the index.
+    """
+    try:
+        store = minute_store(currency_pair)
+        index = GapIndex(store).refresh()
+        start_time_ms = int(start_date.timestamp()) * 1000
+        end_time_ms = int(end_date.timestamp()) * 1000
+        missing = index.missing(start_time_ms, end_time_ms)
+        if not missing:
+            logging.info(f"{currency_pair} | Nothing to backfill")
+            return
+        minutes = sum((end - start) // 60000 + 1 for start, end in missing)
+        logging.info(
+            f"{currency_pair} | Backfilling {len(missing)} ranges, {minutes} minutes"
+        )
+
+        async def fill(time_range: Tuple[int, int]):
+            with store.writer() as writer:
+                await ingest_range(currency_pair, client, writer, *time_range)
+            return time_range
+
+        results = await asyncio.gather(
+            *(fill(i) for i in missing), return_exceptions=True
+        )
+        fetched = []
+        for time_range, result in zip(missing, results):
+            if isinstance(result, BaseException):
+                logging.error(
+                    f"{currency_pair} | Backfill of {time_range} failed: {result!r}"
                 )
-        logging.info(f"{currency_pair} | Complete processing file {file.name}")
+            else:
+                fetched.append(time_range)
+        index.refresh()
+        index.mark_checked(
+            intersect_ranges(index.missing(start_time_ms, end_time_ms), fetched)
+        )
+        logging.info(
+            f"{currency_pair} | Backfill done, {len(index.gaps())} gaps left"
+        )
     except:
-        print(format_exc())
+        logging.error(format_exc())
+
+
+async def populate_all_async(pairs: List[str], backfill: bool = False):
+    job = backfill_pair if backfill else populate_for_pair_async
+    metrics = await start_metrics_server()
+    async with AsyncBinanceKLine() as client:
+        await asyncio.gather(*(job(pair, client) for pair in pairs))
+    if metrics is not None:
+        await metrics.cleanup()
+    logging.info(
+        f"Waited {client.limiter.waited_seconds:.1f}s in total on the rate limiter"
+    )
 
 
 if __name__ == "__main__":
-    with Pool(price_by_minutes_pool_size) as p:
-        p.map(populate_for_pair, currency_pairs)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="only fetch the gaps reported by each pair's index.json",
+    )
+    args = parser.parse_args()
+    if args.backfill:
+        asyncio.run(populate_all_async(currency_pairs, backfill=True))
+    elif price_by_minutes_async:
+        asyncio.run(populate_all_async(currency_pairs))
+    else:
+        run_jobs(
+            populate_for_pair,
+            [minute_job(p) for p in currency_pairs],
+            price_by_minutes_pool_size,
+        )
@@ -0,0 +1,156 @@
+"""Long-running minute ingestion from the Binance combined kline stream.
+
+    python stream_price_by_minutes.py
+
+Subscribes to <pair>@kline_1m for every pair in currency_pairs and appends
+each 1-minute bar to the minute store once it is closed, flushing every
+stream_flush_seconds. Whenever a closed bar does not follow the last stored
+one (first start, reconnect, missed messages), the missing range is fetched
+over REST in the background, so the store stays contiguous.
+"""
+import asyncio
+import json
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from _binance import AsyncBinanceKLine, decode_kline_page
+from _gap_index import GapIndex
+from _list_of_currency_pairs import currency_pairs
+from _metrics import start_metrics_server
+from _store import ChunkedStore, minute_store
+from config import (
+    binance_stream_url,
+    format_exc,
+    logging,
+    start_date_4_populate as start_date,
+    stream_flush_seconds,
+)
+from populate_price_by_minutes import ingest_range
+
+minute_ms = 60_000
+
+
+def kline_event_row(k: dict) -> list:
+    """Stream kline payload in the REST row layout"""
+    return [
+        k["t"], k["o"], k["h"], k["l"], k["c"], k["v"],
+        k["T"], k["q"], k["n"], k["V"], k["Q"], k["B"],
+    ]
+
+
+class KLineStreamIngester:
+    _retry_sleeps = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+    def __init__(
+        self,
+        pairs: List[str],
+        client: AsyncBinanceKLine,
+        stream_url: str = binance_stream_url,
+        flush_seconds: float = stream_flush_seconds,
+    ):
+        self.pairs = pairs
+        self.client = client
+        self.stream_url = stream_url
+        self.flush_seconds = flush_seconds
+        self.stores: Dict[str, ChunkedStore] = {p: minute_store(p) for p in pairs}
+        self.last_open_time: Dict[str, Optional[int]] = {
+            p: store.last_time() for p, store in self.stores.items()
+        }
+        self.pending: Dict[str, List[list]] = {p: [] for p in pairs}
+        self.fills: Dict[str, List[asyncio.Task]] = {p: [] for p in pairs}
+        self.reconnects = 0
+        self.bars = 0
+
+    async def run(self):
+        flusher = asyncio.ensure_future(self._flush_periodically())
+        try:
+            await self._listen()
+        finally:
+            flusher.cancel()
+            self.flush()
+            fills = [t for tasks in self.fills.values() for t in tasks]
+            await asyncio.gather(*fills, return_exceptions=True)
+
+    async def _listen(self):
+        streams = "/".join(f"{p.lower()}@kline_1m" for p in self.pairs)
+        url = f"{self.stream_url}/stream?streams={streams}"
+        attempt = 0
+        while True:
+            try:
+                async with self.client.session.ws_connect(url, heartbeat=60) as ws:
+                    logging.info(f"Stream connected for {len(self.pairs)} pairs")
+                    attempt = 0
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self._on_message(json.loads(message.data))
+                        elif message.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logging.error(format_exc())
+            self.reconnects += 1
+            sleep_time = self._retry_sleeps[min(attempt, len(self._retry_sleeps) - 1)]
+            attempt += 1
+            logging.warning(f"Stream disconnected, reconnecting in {sleep_time}s")
+            await asyncio.sleep(sleep_time)
+
+    def _on_message(self, message: dict):
+        k = message["data"]["k"]
+        pair = k["s"]
+        if not k["x"] or pair not in self.pending:
+            return
+        open_time = int(k["t"])
+        last = self.last_open_time[pair]
+        if last is not None and open_time <= last:
+            return
+        if last is None or open_time > last + minute_ms:
+            fill_start = (
+                int(start_date.timestamp()) * 1000 if last is None else last + minute_ms
+            )
+            self._schedule_fill(pair, fill_start, open_time - minute_ms)
+        self.pending[pair].append(kline_event_row(k))
+        self.last_open_time[pair] = open_time
+        self.bars += 1
+
+    def _schedule_fill(self, pair: str, start_time_ms: int, end_time_ms: int):
+        async def fill():
+            try:
+                logging.info(
+                    f"{pair} | Filling {(end_time_ms - start_time_ms) // minute_ms + 1} "
+                    f"minutes over REST"
+                )
+                with self.stores[pair].writer() as writer:
+                    await ingest_range(pair, self.client, writer, start_time_ms, end_time_ms)
+                GapIndex(self.stores[pair]).refresh()
+            except:
+                logging.error(f"{pair} | {format_exc()}")
+
+        self.fills[pair] = [t for t in self.fills[pair] if not t.done()]
+        self.fills[pair].append(asyncio.ensure_future(fill()))
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            self.flush()
+
+    def flush(self):
+        for pair, rows in self.pending.items():
+            if not rows:
+                continue
+            self.pending[pair] = []
+            try:
+                self.stores[pair].append(decode_kline_page(rows))
+            except:
+                # keep the bars for the next flush
+                self.pending[pair] = rows + self.pending[pair]
+                logging.error(f"{pair} | {format_exc()}")
+
+
+async def stream_all(pairs: List[str]):
+    await start_metrics_server()
+    async with AsyncBinanceKLine() as client:
+        await KLineStreamIngester(pairs, client).run()
+
+
+if __name__ == "__main__":
+    asyncio.run(stream_all(currency_pairs))
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import pytest
+from pytz import UTC
+
+import _store
+import create_daily_price_files as daily
+from _binance import decode_kline_page
+from _binance_standin import synthetic_klines
+from _store import epoch_ms
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(daily, "start_date", datetime(2022, 1, 1, tzinfo=UTC))
+    monkeypatch.setattr(daily, "end_date", datetime(2022, 2, 28, tzinfo=UTC))
+    monkeypatch.setattr(daily, "currency_pairs", ["BTCUSDT"])
+    monkeypatch.setattr(daily, "open_price_file", tmp_path.joinpath("agg_open_price.csv"))
+    monkeypatch.setattr(daily, "max_price_file", tmp_path.joinpath("agg_max_price.csv"))
+    monkeypatch.setattr(daily, "sources_file", tmp_path.joinpath("agg_open_price.sources.json"))
+    root = tmp_path.joinpath("minutes")
+    monkeypatch.setattr(daily, "minute_store", lambda pair: _store.minute_store(pair, root))
+    return _store.minute_store("BTCUSDT", root)
+
+
+def fill(store, start: str, end: str):
+    writer = store.writer()
+    first, stop = epoch_ms(start), epoch_ms(end)
+    for page in range(first, stop, 1000 * 60_000):
+        last = min(page + 999 * 60_000, stop - 60_000)
+        writer.write(decode_kline_page(synthetic_klines("BTCUSDT", 60_000, page, last, 1000)))
+    writer.flush()
+
+
+def tables():
+    return daily.open_price_file.read_text(), daily.max_price_file.read_text()
+
+
+def test_prices_keep_the_exchange_format(store):
+    fill(store, "2022-01-01", "2022-01-03")
+    daily.main()
+    kline = synthetic_klines("BTCUSDT", 60_000, epoch_ms("2022-01-02"), epoch_ms("2022-01-02"), 1)
+    lines = daily.open_price_file.read_text().splitlines()
+    assert lines[1] == f"1,{kline[0][1]},BTCUSDT,2022-01-02"
+    for text in tables():
+        for line in text.splitlines():
+            assert len(line.split(",")[1].split(".")[1]) == 8
+
+
+def test_backfill_recomputes_the_days_it_touched(store):
+    fill(store, "2022-01-01", "2022-01-10 06:00")
+    fill(store, "2022-01-12", "2022-02-03 12:00")
+    daily.main()
+    # a gap filled a month before the last day, and new minutes
+    fill(store, "2022-01-10 06:00", "2022-01-12")
+    fill(store, "2022-02-03 12:00", "2022-02-10")
+    daily.main()
+    incremental = tables()
+
+    for file in (daily.open_price_file, daily.max_price_file, daily.sources_file):
+        file.unlink()
+    daily.main()
+    assert tables() == incremental
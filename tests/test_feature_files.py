@@ -0,0 +1,53 @@
+import os
+
+import pandas as pd
+import pytest
+
+import _feature_files
+from _feature_files import read_features, row_offset
+from _store import epoch_ms
+
+hour = 3_600_000
+
+
+@pytest.fixture(autouse=True)
+def index_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(_feature_files, "feature_index_path", tmp_path.joinpath("index"))
+
+
+def write(file, first: str, rows: int = 48):
+    times = [epoch_ms(first) + i * hour for i in range(rows)]
+    pd.DataFrame({"Open time": times, "Close": [f"{i:05d}.5" for i in range(rows)]}).to_csv(
+        file, index=False
+    )
+
+
+def test_range_read(tmp_path):
+    file = tmp_path.joinpath("720min_AAA.csv")
+    write(file, "2022-01-31")
+    february = read_features(file, epoch_ms("2022-02-01"))
+    assert len(february) == 24
+    assert row_offset(file, epoch_ms("2022-02-01 03:00")) == file.read_text().index(
+        str(epoch_ms("2022-02-01 03:00"))
+    )
+
+
+def test_rewrite_to_the_same_size_rebuilds_the_index(tmp_path):
+    file = tmp_path.joinpath("720min_AAA.csv")
+    write(file, "2022-01-31")
+    assert len(read_features(file, epoch_ms("2022-02-01"))) == 24
+    size, mtime_ns = file.stat().st_size, file.stat().st_mtime_ns
+    # the same bytes per row, 12 more of them in February
+    write(file, "2022-01-31 12:00")
+    os.utime(file, ns=(mtime_ns + 1, mtime_ns + 1))
+    assert file.stat().st_size == size
+    assert len(read_features(file, epoch_ms("2022-02-01"))) == 36
+
+
+def test_open_time_must_be_the_first_column(tmp_path):
+    file = tmp_path.joinpath("720min_AAA.csv")
+    write(file, "2022-01-31")
+    data = pd.read_csv(file)
+    data[["Close", "Open time"]].to_csv(file, index=False)
+    with pytest.raises(ValueError, match="first column"):
+        read_features(file, epoch_ms("2022-02-01"))
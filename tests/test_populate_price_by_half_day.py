@@ -0,0 +1,113 @@
+import json
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from pytz import UTC
+
+import _feature_files
+import populate_price_by_half_day as half_day
+from _binance import decode_kline_page
+from _binance_standin import synthetic_klines
+from _store import epoch_ms, minute_store
+
+raw_columns = [
+    "Open",
+    "High",
+    "Low",
+    "Close",
+    "Volume",
+    "Quote asset volume",
+    "Number of trades",
+    "Taker buy base asset volume",
+    "Taker buy quote asset volume",
+]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(half_day, "start_date", datetime(2022, 1, 1, tzinfo=UTC))
+    monkeypatch.setattr(half_day, "end_date", datetime(2022, 3, 1, tzinfo=UTC))
+    monkeypatch.setattr(half_day, "BUCKET_ROOT", tmp_path)
+    monkeypatch.setattr(half_day, "price_by_half_day_path", tmp_path.joinpath("half_day"))
+    monkeypatch.setattr(half_day, "feature_fingerprints_path", tmp_path.joinpath("fingerprints"))
+    monkeypatch.setattr(_feature_files, "feature_index_path", tmp_path.joinpath("index"))
+    return minute_store("BTCUSDT", tmp_path.joinpath("minutes"))
+
+
+def fill(store, start: str, end: str):
+    """Synthetic minutes from start to end (excluded), with values that need
+    all 17 digits to be written exactly"""
+    writer = store.writer()
+    first, stop = epoch_ms(start), epoch_ms(end)
+    for page in range(first, stop, 1000 * 60_000):
+        last = min(page + 999 * 60_000, stop - 60_000)
+        rows = decode_kline_page(synthetic_klines("BTCUSDT", 60_000, page, last, 1000))
+        noise = np.random.default_rng(page).random(len(rows["open_time"])) * 1e-9 + 1
+        for column, values in rows.items():
+            if values.dtype == np.float64:
+                rows[column] = values * noise
+        writer.write(rows)
+    writer.flush()
+
+
+def feature_files(store):
+    return {i: half_day.feature_file(i, store.name) for i in half_day.intervals}
+
+
+def read_text(file) -> pd.DataFrame:
+    return pd.read_csv(file, dtype=str)
+
+
+def test_incremental_matches_a_full_rebuild(store):
+    # the first bars of February have no minutes, they carry the last close
+    # of January forward
+    fill(store, "2022-01-01", "2022-01-31 20:00")
+    fill(store, "2022-02-01 03:00", "2022-02-10")
+    fill(store, "2022-02-12", "2022-02-20")
+    half_day.populate_by_currency_pair(store.root)
+    # a backfilled gap under rows already built (February is rebuilt on
+    # January's rows), and new minutes
+    fill(store, "2022-02-10", "2022-02-12")
+    fill(store, "2022-02-20", "2022-03-01")
+    half_day.populate_by_currency_pair(store.root)
+    incremental = {i: read_text(f) for i, f in feature_files(store).items()}
+
+    half_day.populate_by_currency_pair(store.root, full=True)
+    for interval, file in feature_files(store).items():
+        rebuilt = read_text(file)
+        # raw columns are written back as they were read, to the byte
+        pd.testing.assert_frame_equal(
+            incremental[interval][["Open time"] + raw_columns], rebuilt[["Open time"] + raw_columns]
+        )
+        features = [c for c in rebuilt.columns if c not in raw_columns]
+        assert half_day.compare_features(
+            interval,
+            incremental[interval][features].astype(np.float64),
+            rebuilt[features].astype(np.float64),
+        )
+
+
+def test_refresh_keeps_unchanged_columns_byte_identical(store):
+    fill(store, "2022-01-01", "2022-03-01")
+    half_day.populate_by_currency_pair(store.root)
+    file = feature_files(store)[half_day.interval_mins]
+    before = read_text(file)
+    stored = json.loads(half_day.fingerprints_file(file).read_text())
+    stored["RSI_10"] = "RSI_10:changed"
+    half_day.fingerprints_file(file).write_text(json.dumps(stored))
+
+    half_day.refresh_columns(file)
+    after = read_text(file)
+    assert list(after.columns) == list(before.columns)
+    unchanged = [c for c in before.columns if c != "RSI_10"]
+    pd.testing.assert_frame_equal(after[unchanged], before[unchanged])
+    assert half_day.compare_features(
+        "RSI_10",
+        after[["Open time", "RSI_10"]].astype(np.float64),
+        before[["Open time", "RSI_10"]].astype(np.float64),
+    )
+    assert json.loads(half_day.fingerprints_file(file).read_text()) == half_day.fingerprints(
+        half_day.x_columns
+    )
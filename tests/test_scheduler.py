@@ -0,0 +1,45 @@
+import logging
+import os
+import signal
+import time
+
+from _scheduler import Job, run_jobs
+
+
+def square(x: int) -> int:
+    time.sleep(0.05 * x)
+    return x * x
+
+
+def raise_on_two(x: int) -> int:
+    if x == 2:
+        raise ValueError("job 2 failed")
+    return square(x)
+
+
+def killed_on_two(x: int) -> int:
+    if x == 2:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return square(x)
+
+
+def jobs(count: int):
+    return [Job(str(i), i, i, 1) for i in range(count)]
+
+
+def test_results_by_job_name():
+    assert run_jobs(square, jobs(4), 2) == {str(i): i * i for i in range(4)}
+
+
+def test_a_raising_job_is_reported_and_the_others_finish(caplog):
+    with caplog.at_level(logging.ERROR):
+        results = run_jobs(raise_on_two, jobs(4), 2)
+    assert results == {"0": 0, "1": 1, "3": 9}
+    assert "ValueError: job 2 failed" in caplog.text
+
+
+def test_a_killed_worker_fails_its_job_instead_of_hanging(caplog):
+    with caplog.at_level(logging.ERROR):
+        results = run_jobs(killed_on_two, jobs(4), 2)
+    assert results == {"0": 0, "1": 1, "3": 9}
+    assert "exited without a result" in caplog.text
@@ -0,0 +1,143 @@
+"""Smoke tests of the training entry points, on a stand-in for tsai.
+
+Only what training_model.py calls is stood in: the forecaster records how
+it was trained, its weights are numpy arrays and torch is numpy.
+"""
+import sys
+import types
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from _walk_forward import PairRows, TrainingSet
+
+
+class Model:
+    def __init__(self, width: int = 16):
+        self.weights = {"encoder": np.zeros((width, 4)), "head": np.zeros(4)}
+
+    def state_dict(self):
+        return {k: v.copy() for k, v in self.weights.items()}
+
+    def load_state_dict(self, weights):
+        assert weights.keys() == self.weights.keys()
+        self.weights = {k: v.copy() for k, v in weights.items()}
+
+
+class Forecaster:
+    def __init__(self, X, y, **kwargs):
+        self.model = Model()
+        self.width = y.shape[1]
+        self.epochs = None
+
+    def lr_find(self):
+        return types.SimpleNamespace(valley=1e-3)
+
+    def fit_one_cycle(self, epochs, lr_max):
+        self.epochs = epochs
+
+    def get_X_preds(self, x):
+        return np.ones((len(x), self.width)), None, None
+
+    def export(self, path):
+        path.write_bytes(b"model")
+
+
+def load_learner(path):
+    return types.SimpleNamespace(model=Model())
+
+
+tsai_all = types.ModuleType("tsai.all")
+tsai_all.set_seed = lambda seed, reproducible: None
+tsai_all.flatten_check = lambda a, b: (np.ravel(a), np.ravel(b))
+tsai_all.torch = types.SimpleNamespace(mean=np.mean, abs=np.abs, tensor=np.asarray)
+tsai_all.TSStandardize = lambda **kwargs: None
+tsai_all.TSForecaster = Forecaster
+tsai_all.TSTPlus = object
+tsai_all.mse = tsai_all.mae = None
+tsai_all.matplotlib = types.SimpleNamespace(
+    pyplot=types.SimpleNamespace(set_loglevel=lambda level: None)
+)
+tsai_all.load_learner = load_learner
+# even where tsai is installed, these tests run on the stand-in
+sys.modules["tsai"] = types.ModuleType("tsai")
+sys.modules["tsai.all"] = tsai_all
+sys.modules.pop("training_model", None)
+
+import training_model  # noqa: E402
+
+
+def training_set() -> TrainingSet:
+    rng = np.random.default_rng(0)
+    X = rng.random((12, 3, 8)).astype(np.float32)
+    y = rng.random((12, 2)).astype(np.float32) + 1
+    pairs = [
+        PairRows("720min_AAA.csv", slice(0, 4), slice(8, 10), slice(0, 1)),
+        PairRows("720min_BBB.csv", slice(4, 8), slice(10, 12), slice(1, 2)),
+    ]
+    return TrainingSet(X, y, X[:2], (list(range(8)), list(range(8, 12))), pairs)
+
+
+@pytest.fixture
+def previous_model(tmp_path):
+    path = tmp_path.joinpath("2024-01-01.pkl")
+    path.write_bytes(b"model")
+    return path
+
+
+def test_cold_start():
+    fcst = training_model.train_forecaster(training_set())
+    assert fcst.epochs == training_model.epochs
+
+
+def test_warm_start_loads_the_previous_weights(monkeypatch, previous_model):
+    previous = Model()
+    previous.weights["head"] += 1
+    monkeypatch.setattr(
+        training_model, "load_learner", lambda path: types.SimpleNamespace(model=previous)
+    )
+    fcst = training_model.train_forecaster(training_set(), previous_model)
+    assert fcst.epochs == training_model.warm_start_epochs
+    assert (fcst.model.weights["head"] == 1).all()
+
+
+def test_missing_previous_model_trains_from_scratch(tmp_path):
+    fcst = training_model.train_forecaster(training_set(), tmp_path.joinpath("none.pkl"))
+    assert fcst.epochs == training_model.epochs
+
+
+def test_other_architecture_trains_from_scratch(monkeypatch, previous_model):
+    monkeypatch.setattr(
+        training_model, "load_learner", lambda path: types.SimpleNamespace(model=Model(32))
+    )
+    fcst = training_model.train_forecaster(training_set(), previous_model)
+    assert fcst.epochs == training_model.epochs
+    assert fcst.model.weights["encoder"].shape == (16, 4)
+
+
+def test_unreadable_previous_model_trains_from_scratch(monkeypatch, previous_model):
+    def broken(path):
+        raise EOFError("truncated pickle")
+
+    monkeypatch.setattr(training_model, "load_learner", broken)
+    fcst = training_model.train_forecaster(training_set(), previous_model)
+    assert fcst.epochs == training_model.epochs
+
+
+def test_compare_warm_start(monkeypatch, tmp_path, previous_model):
+    features = tmp_path.joinpath("features")
+    features.mkdir()
+    features.joinpath("720min_AAA.csv").touch()
+    monkeypatch.setattr(training_model, "price_by_half_day_path", features)
+    monkeypatch.setattr(training_model, "training_output_path", tmp_path)
+    monkeypatch.setattr(training_model, "model_file", lambda work_date: previous_model)
+    monkeypatch.setattr(training_model, "WalkForwardData", lambda *args: None)
+    monkeypatch.setattr(
+        training_model, "assemble_training_set", lambda datasets, work_date: training_set()
+    )
+    comparison = training_model.compare_warm_start(datetime(2024, 1, 2))
+    assert list(comparison.index) == ["all", "720min_AAA.csv", "720min_BBB.csv"]
+    saved = pd.read_csv(tmp_path.joinpath("2024-01-02_warm_start_comparison.csv"))
+    assert list(saved.columns) == ["pair", "warm_smape", "cold_smape", "difference"]
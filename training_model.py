@@ -1,50 +1,52 @@
+import argparse
+import time
 from traceback import format_exc
 import pandas as pd
-from typing import cast, Tuple, List
+from typing import Dict, Optional, List
 
 from pathlib import Path
 import numpy as np
 from datetime import datetime
-from sklearn.preprocessing import StandardScaler
-from dateutil.relativedelta import relativedelta
 import datetime
 from tsai.all import (
     set_seed,
     flatten_check,
     torch,
-    combine_split_data,
     TSStandardize,
     TSForecaster,
     TSTPlus,
     mse,
     mae,
     matplotlib,
+    load_learner,
 )
 
 import datetime
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
 from datetime import datetime, timedelta
 import logging
 
+from _resample import resample_store
+from _store import epoch_ms, minute_store
+from _walk_forward import TrainingSet, WalkForwardData, assemble_training_set, training_dates
 from config import (
+    interval_mins,
     price_by_half_day_path,
+    price_by_minutes_path,
+    start_date_4_populate,
     seed,
-    target_column,
-    X_period,
-    mins,
-    minimum_length_of_days_for_validation_testing,
     num_layers,
     feedforward,
     dropout,
     epochs,
+    warm_start_epochs,
     start_date,
     end_date,
-    x_columns,
-    period,
+    feature_dtype,
     training_models_path,
     training_output_path,
 )
+from populate_price_by_half_day import build_feature_frame
 
 
 matplotlib.pyplot.set_loglevel(level="warning")  # type: ignore
@@ -52,83 +54,54 @@ matplotlib.pyplot.set_loglevel(level="warning")  # type: ignore
 set_seed(seed, True)
 
 
-def run_train_for_period():
-    work_date = start_date.replace(tzinfo=None)
-    while work_date <= end_date.replace(tzinfo=None):
+def run_train_for_period(warm_start: bool = False):
+    first_date = start_date.replace(tzinfo=None)
+    last_date = end_date.replace(tzinfo=None)
+    # every pair is read once for the whole period, each date below only
+    # scales and slices its windows
+    logging.info(f"Loading training data from: {price_by_half_day_path}")
+    datasets = [
+        WalkForwardData(file, first_date, last_date)
+        for file in price_by_half_day_path.iterdir()
+    ]
+    work_date = first_date
+    while work_date <= last_date:
         try:
-            run_train_for_date(work_date)
+            # the first date warm starts too if the day before has a model
+            run_train_for_date(work_date, datasets, warm_start)
         except Exception as e:
             logging.error(format_exc())
             raise e
         work_date += timedelta(days=1)
 
 
-def run_train_for_date(work_date: datetime):
-
-    logging.info(f"Loading training data from: {price_by_half_day_path}")
-
-    x_train = np.array([])
-    y_train = np.array([])
-    x_valid = np.array([])
-    y_valid = np.array([])
-    # Save the separated couples to calculate smape after predictions
-    xy_valid = []
-
-    for file in price_by_half_day_path.iterdir():
-        logging.debug(f"Processing: {file}")
-        x_train_s, y_train_s, x_valid_s, y_valid_s, x_test_s = prepare_training_data(
-            file, work_date
-        )
-        xy_valid.append(
-            {
-                "name": file.name,
-                "x_valid": x_valid_s,
-                "y_valid": y_valid_s,
-                "x_test": x_test_s,
-            }
-        )
-        if len(x_train) == 0:
-            x_train = x_train_s
-            y_train = y_train_s
-            x_valid = x_valid_s
-            y_valid = y_valid_s
-        else:
-            x_train = np.concatenate([x_train_s, x_train])
-            y_train = np.concatenate([y_train_s, y_train])
-            x_valid = np.concatenate([x_valid_s, x_valid])
-            y_valid = np.concatenate([y_valid_s, y_valid])
-    X, y, splits = combine_split_data([x_train, x_valid], [y_train, y_valid])
-    # Now we can train the model
-    logging.info("Running training...")
-    batch_tfms = TSStandardize(by_sample=True, by_var=True)
-    fcst = TSForecaster(
-        X,
-        y,
-        splits=splits,
-        batch_tfms=batch_tfms,
-        bs=128,
-        arch=TSTPlus,
-        metrics=[mse, mae, smape],
-        # device='cuda',
-        arch_config={
-            "dropout": dropout,
-            "fc_dropout": 0.8,
-            "d_model": 16,
-            "n_layers": num_layers,
-            "d_ff": feedforward,
-        },
+def run_train_for_date(
+    work_date: datetime,
+    datasets: Optional[List[WalkForwardData]] = None,
+    warm_start: bool = False,
+):
+
+    if datasets is None:
+        logging.info(f"Loading training data from: {price_by_half_day_path}")
+        datasets = [
+            WalkForwardData(file, work_date, work_date)
+            for file in price_by_half_day_path.iterdir()
+        ]
+
+    # one buffer per array, filled pair by pair; the per-pair evaluation
+    # below slices it
+    training_set = assemble_training_set(datasets, work_date)
+    X, y, splits = training_set.X, training_set.y, training_set.splits
+    x_valid, y_valid = X[len(splits[0]) :], y[len(splits[0]) :]
+    fcst = train_forecaster(
+        training_set, model_file(work_date - timedelta(days=1)) if warm_start else None
     )
-    lr_max = fcst.lr_find()
-    logging.info(f"lf_max = {lr_max.valley}")
-
-    # run the training for #epochs
-    fcst.fit_one_cycle(epochs, lr_max.valley)
     a, _, _ = fcst.get_X_preds(x_valid)
     cal = smape(a, torch.tensor(y_valid))
     cal = cal.numpy()
 
     # Training done. Save the model for later use
-    model_path = training_models_path.joinpath(f"{work_date.strftime('%Y-%m-%d')}.pkl")
+    model_path = model_file(work_date)
     logging.info(f"Saving the model in {model_path}")
     fcst.export(model_path)
 
@@ -137,20 +110,20 @@ def run_train_for_date(work_date: datetime):
     # calculate the smape against the validation set
     logging.info("Calculating SMAPE...")
 
-    for pair in xy_valid:
-        a, _, _ = fcst.get_X_preds(pair["x_valid"])
-        cal = smape(a, torch.tensor(pair["y_valid"]))
+    for pair in training_set.pairs:
+        a, _, _ = fcst.get_X_preds(X[pair.valid])
+        cal = smape(a, torch.tensor(y[pair.valid]))
         cal = cal.numpy()
         da = {
-            "pair": pair["name"],
+            "pair": pair.name,
             "smape": cal,
             "end_test_date": work_date,
         }
         smape_pair = smape_pair.append(da, ignore_index=True)
 
-        a, _, _ = fcst.get_X_preds(pair["x_test"])
+        a, _, _ = fcst.get_X_preds(training_set.x_test[pair.test])
         da = {
-            "pair": pair["name"],
+            "pair": pair.name,
             "smape": a.numpy(),
             "actual_date": work_date,
         }
@@ -172,88 +145,188 @@ def run_train_for_date(work_date: datetime):
     )
 
 
-def prepare_training_data(filename: Path, work_date: datetime):
-    """This function will load the processes data
-    create the training, test and validation set
+def model_file(work_date: datetime) -> Path:
+    return training_models_path.joinpath(f"{work_date.strftime('%Y-%m-%d')}.pkl")
+
+
+def warm_start_weights(model, previous_model: Path) -> bool:
+    """Load the weights of an exported learner into ``model``.
+
+    False, with ``model`` left as it was, when the file is missing, cannot
+    be loaded or holds another architecture (say the layers changed in
+    config.py since it was saved).
     """
-    train_period = relativedelta(months=2)
-    # Prepare dates
-    end_validation_date = work_date - timedelta(days=1)
-    start_validation_date = end_validation_date - timedelta(
-        days=minimum_length_of_days_for_validation_testing
-    )
+    if not previous_model.exists():
+        logging.warning(f"No model in {previous_model}, training from scratch")
+        return False
+    try:
+        weights = load_learner(previous_model).model.state_dict()
+    except Exception:
+        logging.warning(f"Cannot load {previous_model}, training from scratch\n{format_exc()}")
+        return False
+    expected = model.state_dict()
+    mismatched = [
+        k
+        for k in set(weights) | set(expected)
+        if k not in weights or k not in expected or weights[k].shape != expected[k].shape
+    ]
+    if mismatched:
+        logging.warning(
+            f"{previous_model} has another architecture ({', '.join(sorted(mismatched)[:5])}), "
+            "training from scratch"
+        )
+        return False
+    logging.info(f"Warm start from {previous_model}")
+    model.load_state_dict(weights)
+    return True
+
 
-    start_train_date = start_validation_date - train_period
-    end_train_date = start_validation_date - timedelta(days=1)
+def train_forecaster(training_set: TrainingSet, previous_model: Optional[Path] = None):
+    """Train a TSTPlus forecaster on training_set.
 
-    start_test_date = work_date - timedelta(
-        days=minimum_length_of_days_for_validation_testing
+    With ``previous_model`` (an exported learner, e.g. the previous date's)
+    its weights are the starting point and only warm_start_epochs are run;
+    when it is missing or does not fit, the model is trained from scratch.
+    """
+    # Now we can train the model
+    logging.info("Running training...")
+    batch_tfms = TSStandardize(by_sample=True, by_var=True)
+    fcst = TSForecaster(
+        training_set.X,
+        training_set.y,
+        splits=training_set.splits,
+        batch_tfms=batch_tfms,
+        bs=128,
+        arch=TSTPlus,
+        metrics=[mse, mae, smape],
+        # device='cuda',
+        arch_config={
+            "dropout": dropout,
+            "fc_dropout": 0.8,
+            "d_model": 16,
+            "n_layers": num_layers,
+            "d_ff": feedforward,
+        },
     )
-    end_test_date = work_date
-    # Load the data from csv directly here
-    data = pd.read_csv(filename, index_col="Open time", parse_dates=True)
-    data = cast(pd.DataFrame, data)
-
-    # select table with some features
-    temp_table = cast(pd.DataFrame, data[x_columns]).sort_values("Open time")
-    temp_table = cast(pd.DataFrame, temp_table)
-    cols = temp_table.columns.drop(target_column)
-
-    # normalization
-    index = temp_table.index[
-        (temp_table.index >= start_train_date) & (temp_table.index <= end_train_date)
+    n_epochs = epochs
+    if previous_model is not None and warm_start_weights(fcst.model, previous_model):
+        n_epochs = warm_start_epochs
+    lr_max = fcst.lr_find()
+    logging.info(f"lf_max = {lr_max.valley}")
+
+    # run the training for #epochs
+    fcst.fit_one_cycle(n_epochs, lr_max.valley)
+    return fcst
+
+
+def validation_smape(fcst, training_set: TrainingSet) -> Dict[str, float]:
+    """SMAPE of the validation windows of every pair, and of all of them"""
+    valid = slice(len(training_set.splits[0]), len(training_set.X))
+    x_valid, y_valid = training_set.X[valid], training_set.y[valid]
+    a, _, _ = fcst.get_X_preds(x_valid)
+    result = {"all": float(smape(a, torch.tensor(y_valid)))}
+    for pair in training_set.pairs:
+        a, _, _ = fcst.get_X_preds(training_set.X[pair.valid])
+        result[pair.name] = float(smape(a, torch.tensor(training_set.y[pair.valid])))
+    return result
+
+
+def compare_warm_start(work_date: datetime) -> pd.DataFrame:
+    """Validation SMAPE of work_date's model fine-tuned from the previous
+    date's against one trained from scratch, saved next to the test results"""
+    previous_model = model_file(work_date - timedelta(days=1))
+    if not previous_model.exists():
+        raise FileNotFoundError(f"No model in {previous_model} to warm start from")
+    datasets = [
+        WalkForwardData(file, work_date, work_date) for file in price_by_half_day_path.iterdir()
     ]
-    scaler = StandardScaler().fit(temp_table.loc[index, cols])
-
-    # Applied scale and saved into data warehouse
-    temp_table[cols] = scaler.transform(temp_table[cols])
-    # transfering data into time series input and output
-    input_cols = [c for c in temp_table.columns]
-    # Isolates the indexes for the training timeframe
-    ## Train frames
-    x_train, y_train = get_xy_frames(
-        temp_table, input_cols, start_train_date, end_train_date
-    )
-    ## Validate frames
-    x_valid, y_valid = get_xy_frames(
-        temp_table, input_cols, start_validation_date, end_validation_date, k=6
-    )
-    ## Test frames
-    # Isolates the indexed for the testing/predictions timeframe
-    x_test, y_test = get_xy_frames(
-        temp_table, input_cols, start_test_date, end_test_date
+    training_set = assemble_training_set(datasets, work_date)
+    smapes = {}
+    seconds = {}
+    for mode, model in (("warm", previous_model), ("cold", None)):
+        set_seed(seed, True)
+        started = time.perf_counter()
+        fcst = train_forecaster(training_set, model)
+        seconds[mode] = time.perf_counter() - started
+        smapes[mode] = validation_smape(fcst, training_set)
+    comparison = pd.DataFrame(
+        {"warm_smape": smapes["warm"], "cold_smape": smapes["cold"]}
+    ).rename_axis("pair")
+    comparison["difference"] = comparison["warm_smape"] - comparison["cold_smape"]
+    comparison.to_csv(
+        training_output_path.joinpath(
+            f"{work_date.strftime('%Y-%m-%d')}_warm_start_comparison.csv"
+        )
     )
-    return (
-        np.array(x_train),
-        np.array(y_train),
-        np.array(x_valid),
-        np.array(y_valid),
-        np.array(x_test),
+    logging.info(
+        f"Warm start ({warm_start_epochs} epochs, {seconds['warm']:.0f}s): "
+        f"SMAPE {smapes['warm']['all']:.4f}, cold ({epochs} epochs, "
+        f"{seconds['cold']:.0f}s): SMAPE {smapes['cold']['all']:.4f}"
     )
+    return comparison
+
+
+def prepare_training_data(filename: Path, work_date: datetime, dtype: str = feature_dtype):
+    """This function will load the processes data
+    create the training, test and validation set, as ``dtype`` arrays
+    """
+    return WalkForwardData(filename, work_date, work_date).splits(work_date, dtype)
+
 
+def rebuild_features(feature_file: Path, dtype: str) -> pd.DataFrame:
+    """Features of a feature file's pair rebuilt from its minutes in ``dtype``"""
+    pair = feature_file.stem.split("_", 1)[1]
+    store = minute_store(pair, price_by_minutes_path)
+    start_ms, end_ms = epoch_ms(start_date_4_populate), epoch_ms(end_date)
+    bars = resample_store(store, [interval_mins], start_ms, end_ms, origin_ms=start_ms)
+    return build_feature_frame(bars[interval_mins], dtype)
 
-def get_xy_frames(
-    df: pd.DataFrame,
-    input_cols: List[str],
-    start_date: datetime,
-    end_date: datetime,
-    k: int = 0,
-) -> Tuple[List, List]:
-    x_data = []
-    y_data = []
-    delta = timedelta(minutes=(period - 1) * mins)
-    minimum_index = df.index.get_loc(start_date)
-    maximum_index = df.index.get_loc(end_date - delta)
-    if type(minimum_index) == slice:
-        minimum_index = minimum_index.stop
-    if type(maximum_index) == slice:
-        maximum_index = maximum_index.start
-    for i in range(minimum_index, maximum_index + 1):
-        x_frame = df.iloc[i - k : i + X_period - k]
-        y_frame = df.iloc[i + X_period : i + period]
-        x_data.append(x_frame[input_cols].values.T)
-        y_data.append(y_frame[target_column].values)
-    return x_data, y_data
+
+def check_dtype_equivalence(work_date: datetime, dtype: str = feature_dtype) -> bool:
+    """Compare the training arrays of the feature files, stored and built in
+    ``dtype``, with those of the features rebuilt in float64 from the minutes.
+
+    Differences must stay within a few epsilons of ``dtype``, relative to the
+    largest value of each feature. A stored value is off by up to an epsilon
+    of its magnitude and scaling divides that by the feature's spread, so a
+    scaled feature is allowed that much more (max |value| / std of its
+    training rows).
+    """
+    tolerance = 16 * float(np.finfo(dtype).eps)
+    names = ("x_train", "y_train", "x_valid", "y_valid", "x_test")
+    dates = training_dates(work_date)
+    equivalent = True
+    for file in price_by_half_day_path.iterdir():
+        arrays = WalkForwardData(file, work_date, work_date).splits(work_date, dtype)
+        rebuilt = WalkForwardData.from_frame(
+            file.name, rebuild_features(file, "float64"), work_date, work_date
+        )
+        reference = rebuilt.splits(work_date, "float64")
+        fit = rebuilt.values[rebuilt._rows(epoch_ms(dates.start_train), epoch_ms(dates.end_train))]
+        spread = np.nanstd(fit, axis=0)
+        gain = np.nanmax(np.abs(fit), axis=0) / np.where(spread > 0, spread, 1)
+        gain = np.where(rebuilt.scaled, np.maximum(gain, 1), 1)
+        for name, a, b in zip(names, arrays, reference):
+            if a.shape != b.shape:
+                logging.error(f"{file.name} | {name} is {a.shape} in {dtype}, {b.shape} in float64")
+                equivalent = False
+                continue
+            if name.startswith("x"):
+                # (samples, features, X_period): one scale per feature
+                axes, array_gain = (0, 2), gain
+            else:
+                axes, array_gain = None, 1
+            scale = np.maximum(np.nanmax(np.abs(b), axis=axes, initial=0), 1.0) * array_gain
+            error = float(np.max(np.nanmax(np.abs(a - b), axis=axes, initial=0) / scale))
+            if error > tolerance or (np.isnan(a) != np.isnan(b)).any():
+                logging.error(f"{file.name} | {name} differs by {error:.3g} of its scale")
+                equivalent = False
+            else:
+                logging.debug(f"{file.name} | {name} within {error:.3g} of its scale")
+    logging.info(
+        f"{dtype} training arrays {'match' if equivalent else 'DIFFER from'} float64 features"
+    )
+    return equivalent
 
 
 def smape(inp, targ):
@@ -264,11 +337,34 @@ def smape(inp, targ):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--check-dtype",
+        action="store_true",
+        help="compare today's feature_dtype training arrays with float64 and exit",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="fine-tune yesterday's model for warm_start_epochs instead of training from scratch",
+    )
+    parser.add_argument(
+        "--compare-warm-start",
+        action="store_true",
+        help="train today's model both warm started and from scratch, save their "
+        "validation SMAPE side by side and exit",
+    )
+    args = parser.parse_args()
     ## For today
     now = datetime.now()
     today = datetime.combine(now.date(), datetime.min.time())
 
-    run_train_for_date(today)
+    if args.check_dtype:
+        raise SystemExit(0 if check_dtype_equivalence(today) else 1)
+    if args.compare_warm_start:
+        compare_warm_start(today)
+        raise SystemExit(0)
+    run_train_for_date(today, warm_start=args.warm_start)
     ## Or for period
     # # now = datetime(year=2023, month=1, day=1)
     # run_train_for_period()
@@ -0,0 +1,246 @@
+"""Integrity report of the minute stores and the feature files.
+
+    python validate_data.py      # exits with 1 when a pair has errors
+
+Every minute store is scanned a month at a time and every feature file of
+every interval in one read, all checks being array operations. Errors are
+duplicate or out-of-order open times, times off the bar grid and NaN inside
+a feature (past its lookback); gaps, rows with a non-zero "Ignore" (dropped
+by the resampler) and long stale runs are reported as warnings. A stale run
+is a stretch of at least stale_run_minutes with an unchanged close and no
+volume, or of bars fill_missing_values() filled from the previous close. The
+report is written as JSON to validation_report_file.
+"""
+import json
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from _feature_files import read_features
+from _features import registry as feature_registry
+from _resample import interval_ms
+from _store import minute_store
+from config import (
+    format_exc,
+    logging,
+    price_by_half_day_pool_size,
+    price_by_minutes_path,
+    stale_run_minutes,
+    validation_report_file,
+)
+from populate_price_by_half_day import interval_output_path, intervals
+
+minute_ms = 60_000
+
+
+class RunCounter:
+    """Lengths of the runs of True over flags fed a chunk at a time"""
+
+    def __init__(self, minimum: int):
+        self.minimum = minimum
+        self.current = 0
+        self.longest = 0
+        self.long_runs = 0
+
+    def _finish(self, lengths: np.ndarray):
+        if len(lengths):
+            self.longest = max(self.longest, int(lengths.max()))
+            self.long_runs += int((lengths >= self.minimum).sum())
+
+    def update(self, flags: np.ndarray):
+        if not len(flags):
+            return
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], flags.astype(np.int8), [0]))))
+        starts, ends = edges[::2], edges[1::2]
+        lengths = ends - starts
+        if len(lengths) and starts[0] == 0:
+            lengths[0] += self.current
+        else:
+            self._finish(np.array([self.current]))
+        if len(lengths) and ends[-1] == len(flags):
+            self.current = int(lengths[-1])
+            lengths = lengths[:-1]
+        else:
+            self.current = 0
+        self._finish(lengths)
+
+    def report(self) -> dict:
+        self._finish(np.array([self.current]))
+        self.current = 0
+        return {"longest": self.longest, f"at_least_{self.minimum}": self.long_runs}
+
+
+class TimeChecks:
+    """Duplicates, order and gaps of open times fed a chunk at a time"""
+
+    def __init__(self, step_ms: int):
+        self.step_ms = step_ms
+        self.origin: Optional[int] = None
+        self.previous: Optional[int] = None
+        self.rows = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.off_grid = 0
+        self.gaps = 0
+        self.missing = 0
+        self.longest_gap = 0
+
+    def update(self, times: np.ndarray):
+        if not len(times):
+            return
+        if self.origin is None:
+            self.origin = int(times[0])
+            diffs = np.diff(times)
+        else:
+            diffs = np.diff(np.concatenate([[self.previous], times]))
+        self.rows += len(times)
+        self.duplicates += int((diffs == 0).sum())
+        self.out_of_order += int((diffs < 0).sum())
+        self.off_grid += int(((times - self.origin) % self.step_ms != 0).sum())
+        gaps = diffs[diffs > self.step_ms] // self.step_ms - 1
+        self.gaps += len(gaps)
+        self.missing += int(gaps.sum())
+        self.longest_gap = max(self.longest_gap, int(gaps.max(initial=0)))
+        self.previous = int(times[-1])
+
+    def report(self) -> dict:
+        return {
+            "rows": self.rows,
+            "duplicates": self.duplicates,
+            "out_of_order": self.out_of_order,
+            "off_grid": self.off_grid,
+            "gaps": self.gaps,
+            "missing_bars": self.missing,
+            "longest_gap_bars": self.longest_gap,
+        }
+
+
+def validate_minutes(store_dir: Path) -> dict:
+    store = minute_store(store_dir.name, store_dir.parent)
+    times = TimeChecks(minute_ms)
+    stale = RunCounter(stale_run_minutes)
+    floats = [c for c, t in store.schema.items() if np.dtype(t).kind == "f"]
+    nans = dict.fromkeys(floats, 0)
+    ignored = 0
+    previous_close = None
+    for chunk in store.iter_months():
+        times.update(chunk["open_time"])
+        for c in floats:
+            nans[c] += int(np.isnan(chunk[c]).sum())
+        ignored += int((chunk["ignore"] != 0).sum())
+        close = chunk["close"]
+        before = close[:1] + np.nan if previous_close is None else [previous_close]
+        unchanged = np.diff(np.concatenate([before, close])) == 0
+        stale.update(unchanged & (chunk["volume"] == 0))
+        if len(close):
+            previous_close = close[-1]
+    report = times.report()
+    report.update(
+        first=store.first_time(),
+        last=store.last_time(),
+        ignore_nonzero=ignored,
+        nan={c: n for c, n in nans.items() if n},
+        stale_runs=stale.report(),
+    )
+    return report
+
+
+def bars_of(interval: str, minutes: int) -> int:
+    return max(1, minutes * minute_ms // interval_ms(interval))
+
+
+def validate_feature_file(file: Path, interval: str) -> dict:
+    data = read_features(file)
+    times = TimeChecks(interval_ms(interval))
+    times.update(data["Open time"].to_numpy())
+    filled = RunCounter(bars_of(interval, stale_run_minutes))
+    filled.update(
+        (
+            (data["Volume"] == 0)
+            & (data["Open"] == data["Close"])
+            & (data["High"] == data["Close"])
+            & (data["Low"] == data["Close"])
+        ).to_numpy()
+    )
+    nan = {}
+    for c in data.columns.drop("Open time"):
+        missing = data[c].isna().to_numpy()
+        if not missing.any():
+            continue
+        leading = int(missing.argmin()) if not missing.all() else len(missing)
+        nan[c] = {"lookback": leading, "inside": int(missing[leading:].sum())}
+    report = times.report()
+    report.update(filled_runs=filled.report(), nan=nan)
+    return report
+
+
+def errors_of(report: dict, features: bool) -> List[str]:
+    errors = [k for k in ("duplicates", "out_of_order", "off_grid") if report[k]]
+    if features:
+        errors += [
+            f"nan inside {c}"
+            for c, n in report["nan"].items()
+            if n["inside"] or (c not in feature_registry and n["lookback"])
+        ]
+    return errors
+
+
+def warnings_of(report: dict, minimum: int, runs: str) -> List[str]:
+    warnings = []
+    if report["gaps"]:
+        warnings.append(f"{report['gaps']} gaps, {report['missing_bars']} bars missing")
+    if report.get("ignore_nonzero"):
+        warnings.append(f"{report['ignore_nonzero']} rows with a non-zero Ignore")
+    if report[runs][f"at_least_{minimum}"]:
+        warnings.append(
+            f"{report[runs][f'at_least_{minimum}']} {runs.replace('_', ' ')} of "
+            f"{minimum}+ bars, longest {report[runs]['longest']}"
+        )
+    return warnings
+
+
+def validate_pair(store_dir: Path) -> Dict[str, dict]:
+    """Reports of the minute store and of every feature file of a pair"""
+    reports = {}
+    try:
+        report = validate_minutes(store_dir)
+        report["errors"] = errors_of(report, features=False)
+        report["warnings"] = warnings_of(report, stale_run_minutes, "stale_runs")
+        reports["minutes"] = report
+        for interval in intervals:
+            file = interval_output_path(interval).joinpath(f"{interval}_{store_dir.name}.csv")
+            if not file.exists():
+                continue
+            report = validate_feature_file(file, interval)
+            report["errors"] = errors_of(report, features=True)
+            report["warnings"] = warnings_of(
+                report, bars_of(interval, stale_run_minutes), "filled_runs"
+            )
+            reports[interval] = report
+    except:
+        logging.error(f"{store_dir.name} | {format_exc()}")
+        reports["failed"] = {"errors": [format_exc()], "warnings": []}
+    return reports
+
+
+def main() -> bool:
+    store_dirs = sorted(i for i in price_by_minutes_path.iterdir() if i.is_dir())
+    with Pool(price_by_half_day_pool_size) as p:
+        reports = dict(zip((i.name for i in store_dirs), p.map(validate_pair, store_dirs)))
+    valid = True
+    for pair, pair_reports in reports.items():
+        for name, report in pair_reports.items():
+            for error in report["errors"]:
+                logging.error(f"{pair} {name} | {error}")
+                valid = False
+            for warning in report["warnings"]:
+                logging.warning(f"{pair} {name} | {warning}")
+    validation_report_file.write_text(json.dumps(reports, indent=1))
+    logging.info(f"{len(reports)} pairs validated, report in {validation_report_file}")
+    return valid
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if main() else 1)